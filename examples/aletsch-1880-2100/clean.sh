@@ -1,2 +1,3 @@
 rm computational-statistics.txt ex.nc igm-run-parameters.txt *.png igm.py ts.nc
 rm -r __pycache__ trajectories
+rm temp_prec.npy temp_prec-time.npy
@@ -69,6 +69,10 @@ igm.config.weight_Aletschfirn    = 1.0
 igm.config.weight_Jungfraufirn   = 1.0
 igm.config.weight_Ewigschneefeld = 1.0
 
+# the observed surfaces and the seeding area are loaded from geology.nc in addition
+# to the variables needed by igm
+igm.config.ncdf_vars_to_load     = ["surf_" + str(y) for y in [1880, 1926, 1957, 1980, 1999, 2009, 2017]] + ["seeding"]
+
 # This permits to compute particle trajectories
 igm.config.tracking_particles      = False  # activate particle tracking
 igm.config.frequency_seeding       = 2    # we seed every 10 years
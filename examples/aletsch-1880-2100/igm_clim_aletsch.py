@@ -10,7 +10,7 @@ import matplotlib.pyplot as plt
 import numpy as np
 import tensorflow as tf
 import math
-from igm import igm
+from igm import igm, forcing_reader, month_bounds
 import time
 
 class igm_clim_aletsch:
@@ -33,77 +33,66 @@ class igm_clim_aletsch:
         # altitude of the weather station for climate data
         self.zws = 2766
 
-        # read temperature and precipitation data from temp_prec.dat
-        temp_prec = np.loadtxt(
-            os.path.join(self.config.working_dir, "temp_prec.dat"),
-            dtype=np.float32,
-            skiprows=2,
+        # temperature and precipitation data of temp_prec.dat are converted once into
+        # binary files, which are then memory-mapped and read year by year
+        filename = os.path.join(self.config.working_dir, "temp_prec")
+
+        if not os.path.exists(filename + ".npy") or (
+            os.path.getmtime(filename + ".npy") < os.path.getmtime(filename + ".dat")
+        ):
+            temp_prec = np.loadtxt(filename + ".dat", dtype=np.float32, skiprows=2)
+            # the records of a year have times in [year, year+1)
+            np.save(filename + "-time.npy", temp_prec[:, 0].astype(np.float64) + (temp_prec[:, 1] - 1) / 366.0)
+            np.save(filename + ".npy", temp_prec)
+
+        # ten years are kept in memory, the next ones being read in the background
+        self.temp_prec = forcing_reader(
+            filename + ".npy", times=filename + "-time.npy", window=3660
         )
 
-        # find the min and max years from data
-        ymin = int(min(temp_prec[:, 0]))
-        ymax = int(max(temp_prec[:, 0]))
+        nt = 12 if self.config.clim_time_resolution == 12 else 365
 
-        self.temp = np.zeros((365, ymax - ymin + 1), dtype=np.float32)
-        self.prec = np.zeros((365, ymax - ymin + 1), dtype=np.float32)
-        self.year = np.zeros((ymax - ymin + 1), dtype=np.float32)
+        # intitalize the station series of the year, and the 2D corrections, from
+        # which igm evaluates the air_temp and precipitation fields on demand
+        self.station_temp = tf.Variable(tf.zeros(nt), dtype="float32")
+        self.station_prec = tf.Variable(tf.zeros(nt), dtype="float32")
+        self.temp_corr_addi = tf.Variable(tf.zeros_like(self.usurf), dtype="float32")
+        self.prec_corr_mult = tf.Variable(tf.ones_like(self.usurf), dtype="float32")
 
-        # retrieve temp [unit °C] and prec [unit is m ice eq. / y] and year
-        for k, y in enumerate(range(ymin, ymax + 1)):
-            IND = (temp_prec[:, 0] == y) & (temp_prec[:, 1] <= 365)
-            self.prec[:, k] = (
-                temp_prec[IND, -1] * 365.0 / 1000.0
-            ) / 0.917  # new unit is m ice eq. / y
-            self.temp[:, k] = temp_prec[IND, -2]  # new unit is °C
-            self.year[k] = y
-
-        # this make monthly temp and prec if this is wished
-        if self.config.clim_time_resolution==12:
-            II = [0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 364]
-            self.prec = np.stack([np.mean(self.prec[II[i]:II[i+1]],axis=0) 
-                                  for i in range(0,12) ] )
-            self.temp = np.stack([np.mean(self.temp[II[i]:II[i+1]],axis=0) 
-                                  for i in range(0,12) ] )
-
-        # intitalize air_temp and precipitation fields
-        self.air_temp = tf.Variable(
-            tf.zeros((len(self.temp), self.y.shape[0], self.x.shape[0])),
-            dtype="float32",
-        )
-        self.precipitation = tf.Variable(
-            tf.zeros((len(self.prec), self.y.shape[0], self.x.shape[0])),
-            dtype="float32",
-        )
-
-    def update_climate_aletsch(self, force=False):
+    def climate_corrections(self, z):
+        """
+            vertical corrections (lapse rates) of temperature (additive) and precipitation
+            (multiplicative) from the weather station to the elevation z
+        """
 
         dP = 0.00035   # Precipitation vertical gradient
         dT = -0.00552  # Temperature vertical gradient
 
-        # find out the precipitation and temperature at the weather station
-        II = self.year == int(self.t)
-        PREC = tf.expand_dims(
-            tf.expand_dims(np.squeeze(self.prec[:, II]), axis=-1), axis=-1
-        )
-        TEMP = tf.expand_dims(
-            tf.expand_dims(np.squeeze(self.temp[:, II]), axis=-1), axis=-1
-        )
+        return dT * (z - self.zws), 1 + dP * (z - self.zws)
 
-        # extend air_temp and precipitation over the entire glacier and all day of the year
-        self.precipitation.assign(tf.tile(PREC, (1, self.y.shape[0], self.x.shape[0])))
-        self.air_temp.assign(tf.tile(TEMP, (1, self.y.shape[0], self.x.shape[0])))
-
-        # vertical correction (lapse rates)
-        prec_corr_mult = 1 + dP * (self.usurf - self.zws)
-        temp_corr_addi = dT * (self.usurf - self.zws)
+    def update_climate_aletsch(self, force=False):
 
-        prec_corr_mult = tf.expand_dims(prec_corr_mult, axis=0)
-        temp_corr_addi = tf.expand_dims(temp_corr_addi, axis=0)
+        # find out the precipitation and temperature at the weather station
+        year = int(self.scheduler.t)
+        temp_prec = self.temp_prec.get(year, year + 1)
+        temp_prec = temp_prec[temp_prec[:, 1] <= 365]
 
-        prec_corr_mult = tf.tile(prec_corr_mult, (len(self.prec), 1, 1))
-        temp_corr_addi = tf.tile(temp_corr_addi, (len(self.temp), 1, 1))
+        prec = (temp_prec[:, -1] * 365.0 / 1000.0) / 0.917  # new unit is m ice eq. / y
+        temp = temp_prec[:, -2]  # new unit is °C
 
-        # the final precipitation and temperature must have shape (365,ny,ny)
-        self.precipitation.assign(tf.clip_by_value(self.precipitation * prec_corr_mult, 0, 10 ** 10))
-        self.air_temp.assign(self.air_temp + temp_corr_addi)
-        
+        # this make monthly temp and prec if this is wished
+        if self.config.clim_time_resolution==12:
+            II = month_bounds
+            prec = np.stack([np.mean(prec[II[i]:II[i+1]],axis=0) 
+                             for i in range(0,12) ] )
+            temp = np.stack([np.mean(temp[II[i]:II[i+1]],axis=0) 
+                             for i in range(0,12) ] )
+
+        self.station_prec.assign(prec)
+        self.station_temp.assign(temp)
+
+        # the final precipitation and temperature are obtained by broadcasting
+        # the station series (nt,) with these corrections (ny,nx)
+        temp_corr_addi, prec_corr_mult = self.climate_corrections(self.usurf)
+        self.temp_corr_addi.assign(temp_corr_addi)
+        self.prec_corr_mult.assign(prec_corr_mult)
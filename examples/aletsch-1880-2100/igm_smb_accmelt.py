@@ -16,6 +16,7 @@ import tensorflow as tf
 from numpy import dtype
 import argparse
 from netCDF4 import Dataset
+from igm import ncdf_lock, month_bounds
 from scipy.interpolate import interp1d
 
 class igm_smb_accmelt:
@@ -74,18 +75,19 @@ class igm_smb_accmelt:
             load smb data to run the Aletsch Glacier simulation 
         """
 
-        nc = Dataset(
-            os.path.join(self.config.working_dir, self.config.massbalance_file), "r"
-        )
-        x = np.squeeze(nc.variables["x"]).astype("float32")
-        y = np.squeeze(nc.variables["y"]).astype("float32")
-        self.snow_redistribution = np.squeeze(
-            nc.variables["snow_redistribution"]
-        ).astype("float32")
-        self.direct_radiation = np.squeeze(nc.variables["direct_radiation"]).astype(
-            "float32"
-        )
-        nc.close()
+        with ncdf_lock:
+            nc = Dataset(
+                os.path.join(self.config.working_dir, self.config.massbalance_file), "r"
+            )
+            x = np.squeeze(nc.variables["x"]).astype("float32")
+            y = np.squeeze(nc.variables["y"]).astype("float32")
+            self.snow_redistribution = np.squeeze(
+                nc.variables["snow_redistribution"]
+            ).astype("float32")
+            self.direct_radiation = np.squeeze(nc.variables["direct_radiation"]).astype(
+                "float32"
+            )
+            nc.close()
 
         if not hasattr(self, "x"):
             self.x = tf.constant(x, dtype="float32")
@@ -99,6 +101,12 @@ class igm_smb_accmelt:
         db = np.arange(1, 366)
         self.direct_radiation = interp1d(
             da, self.direct_radiation, kind="linear", axis=0, fill_value="extrapolate")(db)
+
+        # and average it monthly if the climate has monthly resolution
+        if getattr(self.config, "clim_time_resolution", 365) == 12:
+            II = month_bounds
+            self.direct_radiation = np.stack([np.mean(self.direct_radiation[II[i]:II[i+1]],axis=0) 
+                                              for i in range(0,12) ] )
                 
         self.direct_radiation = tf.Variable(self.direct_radiation, dtype="float32")
 
@@ -118,9 +126,8 @@ class igm_smb_accmelt:
                + self.config.weight_Jungfraufirn   * self.Jungfraufirn    + (1-self.Jungfraufirn) \
                + self.config.weight_Ewigschneefeld * self.Ewigschneefeld  + (1-self.Ewigschneefeld) )
 
-        # snow_redistribution must have shape like precipitation (365,ny,nx)
-        self.snow_redistribution = tf.expand_dims(self.snow_redistribution, axis=0)
-        self.snow_redistribution = tf.tile(self.snow_redistribution, (365, 1, 1))
+        # snow_redistribution has shape (ny,nx), it applies to all days of the year
+        self.snow_redistribution = tf.constant(self.snow_redistribution)
 
         # define the year-corresponding indice in the mb_parameters file
         self.IMB = np.zeros((221), dtype="int32")
@@ -130,10 +137,53 @@ class igm_smb_accmelt:
             )[0]
         self.IMB = tf.Variable(self.IMB)
 
-    # Warning: The decorator permits to take full benefit from efficient TensorFlow operation (especially on GPU)
-    # Note that tf.function works best with TensorFlow ops; NumPy and Python calls are converted to constants.
-    # Therefore: you must make sure any variables are TensorFlow Tensor (and not Numpy)
-    @tf.function()
+    def ncdf_vars_accmelt(self):
+        """
+            variables of the geology file the accmelt smb needs, i.e. the masks of
+            the accumulation basins
+        """
+
+        return ["Aletschfirn", "Jungfraufirn", "Ewigschneefeld"]
+
+    def ensemble_params_accmelt(self):
+        """
+            parameters of the accmelt smb that may vary among the members of an ensemble
+        """
+
+        return ["weight_ablation", "weight_accumulation", "thr_temp_snow", "thr_temp_rain"]
+
+    def smb_cache_params_accmelt(self):
+        """
+            parameters the cached inputs of the accmelt smb depend on (beside the
+            surface), used by igm as key of the smb cache, the year setting the climate,
+            and the forcing files being keyed by their path and modification time. The
+            weights and melt parameters are applied after the cache lookup
+        """
+
+        year = math.floor(self.scheduler.t)
+
+        files = [self.config.massbalance_file, "mbparameter.dat"] + {
+            "aletsch": ["temp_prec.dat"],
+            "gridded": [self.config.clim_gridded_file],
+        }.get(self.config.type_climate, [])
+
+        files = [os.path.abspath(os.path.join(self.config.working_dir, f)) for f in files]
+
+        return (
+            year,
+            np.asarray(self.get_param("thr_temp_snow")).tolist(),
+            np.asarray(self.get_param("thr_temp_rain")).tolist(),
+            self.config.shift_hydro_year,
+            self.config.weight_Aletschfirn,
+            self.config.weight_Jungfraufirn,
+            self.config.weight_Ewigschneefeld,
+            self.config.type_climate,
+            getattr(self.config, "clim_time_resolution", 365),
+            [(f, os.path.getmtime(f)) for f in files if os.path.exists(f)],
+            self.config.smb_elevation_bands,
+            self.config.smb_band_classes,
+        )
+
     def update_smb_accmelt(self):
         """
             Mass balance forced by climate with accumulation and temperature-index melt model [Hock, 1999; Huss et al., 2009]. 
@@ -145,64 +195,260 @@ class igm_smb_accmelt:
             Check at this latest paper for the model description corresponding to this implementation
         """
 
-        # update melt paramters
-        Fm = self.mb_parameters[self.IMB[int(self.t) - 1880], 2] * 10 ** (-3)
-        ri = self.mb_parameters[self.IMB[int(self.t) - 1880], 3] * 10 ** (-5)
-        rs = self.mb_parameters[self.IMB[int(self.t) - 1880], 4] * 10 ** (-5)
+        if self.config.smb_elevation_bands > 0:
+            # the model runs per elevation band (and class of the spatial maps),
+            # and is then interpolated in elevation
+            index, zb, count = self.accmelt_elevation_bands()
+            smb = self.compute_smb_accmelt(index)
+            self.smb.assign(self.band_interp(smb, index, zb, count))
+        else:
+            self.smb.assign(self.compute_smb_accmelt())
+
+    def accmelt_elevation_bands(self):
+        """
+            elevation bands (and classes of the spatial maps) of the accmelt smb
+        """
+
+        return self.elevation_bands(
+            [self.snow_redistribution, tf.math.reduce_mean(self.direct_radiation, axis=0)]
+        )
+
+    def smb_cache_fields_accmelt(self):
+        """
+            inputs of the accmelt smb over the year that do not depend on the weights,
+            i.e. the accumulation before weight_accumulation and the positive temperature
+            at each climate step, which igm caches instead of the smb, such that runs
+            changing only the weights hit the cache (on identical surfaces). They take
+            the memory of two climate fields per climate step
+        """
+
+        if self.config.smb_elevation_bands > 0:
+            index, _, _ = self.accmelt_elevation_bands()
+            return self.compute_smb_accmelt_inputs(index)
+        else:
+            return self.compute_smb_accmelt_inputs()
+
+    def smb_from_cache_fields_accmelt(self, fields):
+        """
+            compute the accmelt smb from its cached inputs, applying the weights
+        """
+
+        if self.config.smb_elevation_bands > 0:
+            index, zb, count = self.accmelt_elevation_bands()
+            smb = self.integrate_smb_accmelt(fields, index)
+            self.smb.assign(self.band_interp(smb, index, zb, count))
+        else:
+            self.smb.assign(self.integrate_smb_accmelt(fields))
+
+    def accmelt_melt_factors(self):
+        """
+            melt factor, and radiation factors for ice and snow, of the current year
+        """
+
+        # the year is read from the variable t at each call
+        IMB = self.IMB[tf.cast(self.t, "int32") - 1880]
+        Fm = self.mb_parameters[IMB, 2] * 10 ** (-3)
+        ri = self.mb_parameters[IMB, 3] * 10 ** (-5)
+        rs = self.mb_parameters[IMB, 4] * 10 ** (-5)
+
+        return Fm, ri, rs
+
+    def accmelt_inputs(self, climate, k, snow_redistribution, nt):
+        """
+            accumulation (before weight_accumulation) and positive temperature at the
+            climate step k
+        """
+
+        # these parameters have shape (N,1,1) if they vary among the N members
+        thr_temp_snow = self.get_param("thr_temp_snow")
+        thr_temp_rain = self.get_param("thr_temp_rain")
+
+        # fields are evaluated for this step only
+        air_temp, precipitation = self.climate_step(climate, k)
 
         # keep solid precipitation when temperature < thr_temp_snow
         # with linear transition to 0 between thr_temp_snow and thr_temp_rain
         accumulation = tf.where(
-            self.air_temp <= self.config.thr_temp_snow,
-            self.precipitation,
+            air_temp <= thr_temp_snow,
+            precipitation,
             tf.where(
-                self.air_temp >= self.config.thr_temp_rain,
+                air_temp >= thr_temp_rain,
                 0.0,
-                self.precipitation
-                * (self.config.thr_temp_rain - self.air_temp)
-                / (self.config.thr_temp_rain - self.config.thr_temp_snow),
+                precipitation
+                * (thr_temp_rain - air_temp)
+                / (thr_temp_rain - thr_temp_snow),
             ),
         )
 
-        # unit to [ m ice eq. / y ] -> [ m ice eq. / d ]
-        accumulation /= accumulation.shape[0] 
+        # unit to [ m ice eq. / y ] -> [ m ice eq. / climate step ]
+        accumulation /= nt
 
         # correct for snow re-distribution
-        accumulation *= self.snow_redistribution  # unit to [ m ice eq. / d ]
+        accumulation *= snow_redistribution
 
-        accumulation *= self.config.weight_accumulation  # unit to [ m ice eq. / d ]
+        pos_temp = tf.where(air_temp > 0.0, air_temp, 0.0)  # unit is [°C]
 
-        pos_temp = tf.where(self.air_temp > 0.0, self.air_temp, 0.0)  # unit is [°C]
+        return accumulation, pos_temp
+
+    def accmelt_step(self, snow_depth, smb, accumulation, pos_temp, radiation, ndays):
+        """
+            integrate the snow depth and the smb over one climate step
+        """
+
+        Fm, ri, rs = self.accmelt_melt_factors()
+
+        # these parameters have shape (N,1,1) if they vary among the N members
+        weight_ablation = self.get_param("weight_ablation")
+        weight_accumulation = self.get_param("weight_accumulation")
+
+        accumulation *= weight_accumulation
+
+        # add accumulation to the snow depth
+        snow_depth += accumulation
+
+        # the ablation (unit is m ice eq. / climate step) is the product
+        # of positive temp  with melt factors for ice, or snow
+        # (Fm + ris * self.direct_radiation has unit [m ice eq. / (°C d)] )
+        ablation = tf.where(
+            snow_depth == 0,
+            pos_temp * (Fm + ri * radiation),
+            pos_temp * (Fm + rs * radiation),
+        ) * ndays
+
+        ablation *= weight_ablation
+
+        # remove snow melt to snow depth, and cap it as snow_depth can not be negative
+        snow_depth = tf.clip_by_value(snow_depth - ablation, 0.0, 1.0e10)
+
+        # Time integration of accumulation minus ablation
+        return snow_depth, smb + (accumulation - ablation)
+
+    def accmelt_spatial_maps(self, index):
+        """
+            snow redistribution and direct radiation, averaged over the elevation
+            bands if their index is given
+        """
+
+        if index is None:
+            return self.snow_redistribution, self.direct_radiation
+        else:
+            return (
+                self.band_mean(self.snow_redistribution, index),
+                self.band_mean(self.direct_radiation, index),
+            )
+
+    # Warning: The decorator permits to take full benefit from efficient TensorFlow operation (especially on GPU)
+    # Note that tf.function works best with TensorFlow ops; NumPy and Python calls are converted to constants.
+    # Therefore: you must make sure any variables are TensorFlow Tensor (and not Numpy)
+    @tf.function()
+    def compute_smb_accmelt(self, index=None):
+        """
+            return the accmelt smb on the grid, or per elevation band if the band index
+            of each cell is given, the spatial inputs being then averaged over the bands
+        """
+
+        # number of climate steps in the year (365 daily, or 12 monthly)
+        nt = self.climate_steps()
+
+        # number of days per climate step, as the melt factors are daily
+        ndays = 365.0 / nt
+
+        climate = self.climate_state(index)
+
+        snow_redistribution, direct_radiation = self.accmelt_spatial_maps(index)
+
+        # The year is integrated step by step with running accumulators for the snow
+        # depth and the mass balance, such that nothing is stored per day
+        def body(kk, snow_depth, smb):
 
-        ablation = []  # [ unit : ice-eq. m / d ]
- 
-        # the snow depth (=0 or >0) is necessary to find what melt factor to apply
-        snow_depth = tf.zeros((self.air_temp.shape[1], self.air_temp.shape[2]))
-            
-        for kk in range(self.air_temp.shape[0]):
-             
             # shift to hydro year, i.e. start Oct. 1
-            k = (kk+int(self.air_temp.shape[0]*self.config.shift_hydro_year))%(self.air_temp.shape[0]) 
-
-            # add accumulation to the snow depth
-            snow_depth += accumulation[k]
-
-            # the ablation (unit is m ice eq. / d) is the product
-            # of positive temp  with melt factors for ice, or snow
-            # (Fm + ris * self.direct_radiation has unit [m ice eq. / (°C d)] )
-            ablation.append(
-                tf.where(
-                    snow_depth == 0,
-                    pos_temp[k] * (Fm + ri * self.direct_radiation[k]),
-                    pos_temp[k] * (Fm + rs * self.direct_radiation[k]),
-                )
+            k = (kk + int(nt * self.config.shift_hydro_year)) % nt
+
+            accumulation, pos_temp = self.accmelt_inputs(climate, k, snow_redistribution, nt)
+
+            snow_depth, smb = self.accmelt_step(
+                snow_depth, smb, accumulation, pos_temp, direct_radiation[k], ndays
             )
 
-            ablation[-1] *= self.config.weight_ablation
+            return kk + 1, snow_depth, smb
 
-            # remove snow melt to snow depth, and cap it as snow_depth can not be negative
-            snow_depth = tf.clip_by_value(snow_depth - ablation[-1], 0.0, 1.0e10)
+        # the snow depth (=0 or >0) is necessary to find what melt factor to apply,
+        # the accumulators have the shape of the climate fields (with members if any)
+        zeros = tf.zeros_like(self.climate_step(climate, 0)[0] * snow_redistribution)
 
-        # Time integration of accumulation minus ablation
-        self.smb.assign(tf.math.reduce_sum(accumulation - ablation, axis=0))
-        
+        _, _, smb = tf.while_loop(
+            lambda kk, snow_depth, smb: kk < nt, body, [tf.constant(0), zeros, zeros]
+        )
+
+        return smb
+
+    @tf.function()
+    def compute_smb_accmelt_inputs(self, index=None):
+        """
+            return the accumulation and positive temperature of all climate steps of the
+            hydro year, stacked with shape (2,nt,...)
+        """
+
+        nt = self.climate_steps()
+
+        climate = self.climate_state(index)
+
+        snow_redistribution, _ = self.accmelt_spatial_maps(index)
+
+        def body(kk, A, T):
+
+            k = (kk + int(nt * self.config.shift_hydro_year)) % nt
+
+            accumulation, pos_temp = self.accmelt_inputs(climate, k, snow_redistribution, nt)
+
+            # the accumulation has the shape of the members if the thresholds vary
+            pos_temp = tf.broadcast_to(pos_temp, tf.shape(accumulation))
+
+            return kk + 1, A.write(kk, accumulation), T.write(kk, pos_temp)
+
+        _, A, T = tf.while_loop(
+            lambda kk, A, T: kk < nt,
+            body,
+            [
+                tf.constant(0),
+                tf.TensorArray("float32", size=nt),
+                tf.TensorArray("float32", size=nt),
+            ],
+        )
+
+        return tf.stack([A.stack(), T.stack()])
+
+    @tf.function()
+    def integrate_smb_accmelt(self, fields, index=None):
+        """
+            return the accmelt smb from the inputs of compute_smb_accmelt_inputs
+        """
+
+        nt = self.climate_steps()
+
+        ndays = 365.0 / nt
+
+        _, direct_radiation = self.accmelt_spatial_maps(index)
+
+        def body(kk, snow_depth, smb):
+
+            k = (kk + int(nt * self.config.shift_hydro_year)) % nt
+
+            snow_depth, smb = self.accmelt_step(
+                snow_depth, smb, fields[0, kk], fields[1, kk], direct_radiation[k], ndays
+            )
+
+            return kk + 1, snow_depth, smb
+
+        # the weights may add the dimension of the members
+        zeros = tf.zeros_like(
+            fields[0, 0]
+            * self.get_param("weight_accumulation")
+            * self.get_param("weight_ablation")
+        )
+
+        _, _, smb = tf.while_loop(
+            lambda kk, snow_depth, smb: kk < nt, body, [tf.constant(0), zeros, zeros]
+        )
+
+        return smb
@@ -1,3 +1,4 @@
 rm ex-thk.mp4 ex.nc ts.nc computational-statistics.txt 
 rm  igm-run-parameters.txt
 rm -r trajectories
+rm data-for-paleo-tuto/EDC_dD_temp_estim-*.npy
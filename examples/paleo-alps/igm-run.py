@@ -2,9 +2,9 @@
 
 import tensorflow as tf
 import math
-from igm import igm
+from igm import igm, forcing_reader
 import numpy as np
-from scipy.interpolate import interp1d
+import os
  
 class igm(igm):
 
@@ -12,11 +12,21 @@ class igm(igm):
         """
             Retrieve the Temperature difference from the EPICA signal
         """
-        # load the EPICA signal from the official data
-        ss = np.loadtxt('data-for-paleo-tuto/EDC_dD_temp_estim.tab',dtype=np.float32,skiprows=31)
-        time = ss[:,1] * -1000  # extract time BP, chnage unit to yeat
-        dT   = ss[:,3]          # extract the dT, i.e. global temp. difference
-        self.dT =  interp1d(time,dT, fill_value=(dT[0], dT[-1]),bounds_error=False)
+        filename = 'data-for-paleo-tuto/EDC_dD_temp_estim'
+        # the official data are converted once into binary files, which are then
+        # memory-mapped and read by windows around the current time, they are
+        # converted again if the official data are more recent
+        if not os.path.exists(filename + '-dT.npy') or (
+            os.path.getmtime(filename + '-dT.npy') < os.path.getmtime(filename + '.tab')
+        ):
+            # load the EPICA signal from the official data
+            ss = np.loadtxt(filename + '.tab',dtype=np.float32,skiprows=31)
+            time = ss[:,1] * -1000  # extract time BP, chnage unit to yeat
+            dT   = ss[:,3]          # extract the dT, i.e. global temp. difference
+            I = np.argsort(time)    # the reader needs increasing times
+            np.save(filename + '-time.npy', time[I].astype(np.float64))
+            np.save(filename + '-dT.npy', dT[I])
+        self.dT = forcing_reader(filename + '-dT.npy', times=filename + '-time.npy')
 
     def update_smb_signal(self):
         """
@@ -29,7 +39,7 @@ class igm(igm):
             self.already_called_update_smb_signal = True
 
         # define ELA as function of EPICA's Delta T, ELA's present day (pdela) and Dela/Dt (deladt)
-        ela     = self.config.pdela + self.config.deladt*self.dT(self.t) # for rhine
+        ela     = self.config.pdela + self.config.deladt*self.dT.interp(self.scheduler.t) # for rhine
 
         # that's SMB param with ELA, ablation and accc gradient, and max accumulation
         # i.e. SMB =       gradabl*(z-ela)           if z<ela, 
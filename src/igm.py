@@ -9,6 +9,7 @@ Published under the GNU GPL (Version 3), check at the LICENSE file
 # functions are sorted by thema, which are
 
 #      INITIALIZATION : contains all to initialize variables
+#      ENSEMBLE : Run several members with perturbed parameters at once
 #      I/O NCDF : Files for data Input/Output using NetCDF file format
 #      COMPUTE T AND DT : Function to compute adaptive time-step and time
 #      ICEFLOW : Containt the function that serve compute the emulated iceflow
@@ -25,7 +26,8 @@ Published under the GNU GPL (Version 3), check at the LICENSE file
 
 ####################################################################################
 
-import os, sys, shutil, glob
+import os, sys, shutil, glob, atexit, json, abc
+import threading, queue, multiprocessing, contextlib, traceback, hashlib
 import numpy as np
 import matplotlib.pyplot as plt
 import datetime, time
@@ -43,6 +45,646 @@ def str2bool(v):
 
 ####################################################################################
 
+# the NetCDF library is not thread-safe, this serializes all the accesses to NetCDF
+# files, which may be made by the background threads (output writer, forcing prefetch)
+ncdf_lock = threading.Lock()
+
+class ncdf_writer:
+    """
+    Keep a NetCDF output file open over the whole run, track the record index
+    in memory and buffer snapshots in a preallocated ring of numpy arrays,
+    which is flushed as one hyperslab write along the time dimension
+    """
+
+    def __init__(self, filename, buffer_size=1):
+
+        with ncdf_lock:
+            self.nc = Dataset(filename, "w", format="NETCDF4")
+
+            self.nc.createDimension("time", None)
+            E = self.nc.createVariable("time", np.dtype("float32").char, ("time",))
+            E.units = "yr"
+            E.long_name = "time"
+            E.axis = "T"
+
+        self.buffer_size = max(int(buffer_size), 1)
+        self.nrec = 0  # number of records already on disk
+        self.nbuf = 0  # number of records waiting in the buffer
+        self.tbuf = np.zeros(self.buffer_size, dtype="float32")
+        self.buffer = {}
+        self.clip = {}
+
+    def add_coordinate(self, name, values, units, axis, standard_name=None):
+
+        with ncdf_lock:
+            self.nc.createDimension(name, len(values))
+            E = self.nc.createVariable(name, np.dtype("float32").char, (name,))
+            E.units = units
+            E.long_name = name
+            if standard_name is not None:
+                E.standard_name = standard_name
+            E.axis = axis
+            E[:] = values
+
+    def add_variable(
+        self, name, dims, long_name, units, standard_name=None, encoding=None
+    ):
+        """
+        encoding contains optional createVariable keywords (zlib, complevel,
+        shuffle, chunksizes, least_significant_digit), and pack_range=[min,max]
+        to store the variable as int16 with scale_factor and add_offset
+        """
+
+        encoding = {} if encoding is None else dict(encoding)
+        pack_range = encoding.pop("pack_range", None)
+
+        with ncdf_lock:
+            if pack_range is None:
+                E = self.nc.createVariable(
+                    name, np.dtype("float32").char, ("time",) + dims, **encoding
+                )
+            else:
+                E = self.nc.createVariable(
+                    name, np.dtype("int16").char, ("time",) + dims,
+                    fill_value=np.int16(-32768), **encoding
+                )
+                E.scale_factor = np.float32((pack_range[1] - pack_range[0]) / 65533)
+                E.add_offset = np.float32((pack_range[1] + pack_range[0]) / 2)
+                self.clip[name] = pack_range
+
+            E.long_name = long_name
+            if standard_name is not None:
+                E.standard_name = standard_name
+            E.units = units
+
+            shape = tuple(len(self.nc.dimensions[d]) for d in dims)
+        self.buffer[name] = np.zeros((self.buffer_size,) + shape, dtype="float32")
+
+    def append(self, t, fields):
+
+        self.tbuf[self.nbuf] = t
+        for var in self.buffer:
+            self.buffer[var][self.nbuf] = fields[var]
+        self.nbuf += 1
+
+        if self.nbuf == self.buffer_size:
+            self.flush()
+
+    def flush(self):
+
+        if not self.nc.isopen():
+            raise IOError("ncdf file closed before all records were written")
+
+        if self.nbuf > 0:
+            d0, d1 = self.nrec, self.nrec + self.nbuf
+            for var in self.clip:
+                np.clip(self.buffer[var], *self.clip[var], out=self.buffer[var])
+            with ncdf_lock:
+                self.nc.variables["time"][d0:d1] = self.tbuf[: self.nbuf]
+                for var in self.buffer:
+                    self.nc.variables[var][d0:d1] = self.buffer[var][: self.nbuf]
+                self.nc.sync()
+            self.nrec = d1
+            self.nbuf = 0
+
+    def close(self):
+
+        if self.nc.isopen():
+            self.flush()
+            with ncdf_lock:
+                self.nc.close()
+
+####################################################################################
+
+class forcing_reader:
+    """
+    Read a forcing along its time axis by windows of records, the next window being
+    prefetched in a background thread, such that the memory use does not depend on
+    the length of the forcing. The forcing is either a npy file, which is memory-mapped,
+    or a variable of a NetCDF file, with time along the first axis. The (increasing)
+    times of the records are given as array or npy file, or read from the variable
+    time of the NetCDF file
+    """
+
+    def __init__(self, filepath, varname=None, times=None, window=1000, prefetch=True):
+
+        if filepath.endswith(".nc"):
+            with ncdf_lock:
+                self.nc = Dataset(filepath, "r")
+                self.data = self.nc.variables[varname]
+                if times is None:
+                    times = np.array(self.nc.variables["time"][:], dtype="float64")
+        else:
+            self.nc = None
+            self.data = np.load(filepath, mmap_mode="r")
+
+        if isinstance(times, str):
+            self.times = np.load(times, mmap_mode="r")
+        else:
+            self.times = np.asarray(times)
+
+        assert len(self.times) == self.data.shape[0]
+
+        self.window = max(int(window), 1)
+        self.prefetch = prefetch
+        self.start = 0
+        self.buffer = self.read(0, 0)
+        self.next = None
+        self.thread = None
+
+    def read(self, i0, i1):
+        """
+        read the records i0 to i1 from the file
+        """
+
+        if self.nc is None:
+            return np.array(self.data[i0:i1], dtype="float32")
+        else:
+            with ncdf_lock:
+                return np.ma.filled(self.data[i0:i1], np.nan).astype("float32")
+
+    def fetch(self, i0):
+        """
+        read the window starting at record i0 in the background
+        """
+
+        i1 = min(i0 + self.window, len(self.times))
+
+        def run():
+            self.next = (i0, self.read(i0, i1))
+
+        self.thread = threading.Thread(target=run, daemon=True)
+        self.thread.start()
+
+    def wait(self):
+
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def records(self, i0, i1):
+        """
+        return the records i0 to i1, from the windows in memory if possible
+        """
+
+        n = len(self.times)
+        end = self.start + len(self.buffer)
+
+        if (i0 < self.start) | (i1 > end):
+
+            self.wait()
+
+            if (
+                (self.next is not None)
+                and (self.next[0] == end)
+                and (i0 >= self.start)
+                and (i1 <= end + len(self.next[1]))
+            ):
+                # the request continues in the prefetched window
+                k = min(i0 - self.start, len(self.buffer))
+                self.buffer = np.concatenate([self.buffer[k:], self.next[1]])
+                self.start += k
+            else:
+                self.buffer = self.read(i0, max(i1, min(i0 + self.window, n)))
+                self.start = i0
+
+            self.next = None
+
+            if self.prefetch & (self.start + len(self.buffer) < n):
+                self.fetch(self.start + len(self.buffer))
+
+        return self.buffer[i0 - self.start : i1 - self.start]
+
+    def get(self, t0, t1):
+        """
+        return the records whose time is in [t0, t1)
+        """
+
+        i0 = int(np.searchsorted(self.times, t0, side="left"))
+        i1 = int(np.searchsorted(self.times, t1, side="left"))
+
+        return self.records(i0, i1)
+
+    def interp(self, t):
+        """
+        linear interpolation of the forcing at time t, constant beyond its ends
+        """
+
+        assert len(self.times) > 1
+
+        i = int(np.clip(np.searchsorted(self.times, t, side="right") - 1, 0, len(self.times) - 2))
+
+        t0, t1 = float(self.times[i]), float(self.times[i + 1])
+        w = np.clip((t - t0) / max(t1 - t0, 1.0e-12), 0, 1)
+
+        r = self.records(i, i + 2)
+
+        return (1 - w) * r[0] + w * r[1]
+
+    def close(self):
+
+        self.wait()
+
+        if self.nc is not None:
+            with ncdf_lock:
+                self.nc.close()
+
+####################################################################################
+
+class scheduler:
+    """
+    Owns the simulation time on the host (float64), the igm variable t being its
+    device mirror, and the next due time of the periodic components, which check
+    themselves against it, such that these frequency checks do not need any
+    transfer from the device
+    """
+
+    def __init__(self, t):
+
+        self.t = float(t)
+        self.freq = {}
+        self.last = {}
+        self.next = {}
+
+    def register(self, name, freq, tlast=-np.inf):
+        """
+        register a component called every freq years, last called at tlast
+        """
+
+        self.freq[name] = freq
+        self.push(name, tlast)
+
+    def push(self, name, tlast):
+
+        self.last[name] = tlast
+        self.next[name] = tlast + self.freq[name]
+
+    def due(self, name, force=False):
+        """
+        return True if the component is due (or forced) at the current time,
+        in which case it is rescheduled
+        """
+
+        if force | (self.next[name] <= self.t):
+            self.push(name, self.t)
+            return True
+        else:
+            return False
+
+####################################################################################
+
+def set_num_threads(intra, inter):
+    """
+    Limit the number of threads used by TensorFlow within (intra) and across
+    (inter) operations, 0 keeps the default. This must be done before
+    TensorFlow runs its first operation
+    """
+
+    if (intra > 0) & (tf.config.threading.get_intra_op_parallelism_threads() != intra):
+        tf.config.threading.set_intra_op_parallelism_threads(intra)
+
+    if (inter > 0) & (tf.config.threading.get_inter_op_parallelism_threads() != inter):
+        tf.config.threading.set_inter_op_parallelism_threads(inter)
+
+# default number of threads of the TFLite and ONNX Runtime backends, set to the
+# share of the cores of each worker process in a parameter sweep
+backend_threads = os.cpu_count()
+
+# process-level registry of the models, keyed by path, and of the modules
+# holding their compiled functions, keyed by path and input shape
+keras_models = {}
+model_functions = {}
+
+# process-level LRU cache of smb fields, such that runs repeated in the same
+# process (e.g. calibration loops) share them, the most recent being last
+smb_fields = {}
+
+# first day of each month and number of days of the year, to average daily
+# climate series (and inputs of the smb models) monthly
+month_bounds = [0, 31, 59, 90, 120, 151, 181, 212, 243, 273, 304, 334, 365]
+
+def load_keras_model(filepath, precision="float32"):
+    """
+    Load a keras model once per process, further calls return the same model.
+    With precision float16 or bfloat16, the model is cloned with all layers
+    (and therefore weights and computations) in that precision
+    """
+
+    # the same file may be given with different paths (relative, absolute)
+    filepath = os.path.abspath(filepath)
+
+    if not filepath in keras_models:
+        keras_models[filepath] = tf.keras.models.load_model(filepath)
+
+    if precision == "float32":
+        return keras_models[filepath]
+
+    if not (filepath, precision) in keras_models:
+
+        def clone_layer(layer):
+            config = layer.get_config()
+            config["dtype"] = precision
+            return layer.__class__.from_config(config)
+
+        model = keras_models[filepath]
+        clone = tf.keras.models.clone_model(model, clone_function=clone_layer)
+        for w, v in zip(clone.weights, model.weights):
+            w.assign(tf.cast(v, w.dtype))
+        keras_models[(filepath, precision)] = clone
+
+    return keras_models[(filepath, precision)]
+
+def get_model_function(filepath, shape, cache_dir="", precision="float32"):
+    """
+    Return the keras model filepath traced as a concrete function for float32
+    inputs of the given shape (None for any batch size), once per process. In
+    reduced precision, the inputs are cast to precision and the outputs back
+    to float32. If cache_dir is given, the traced function is saved there as
+    SavedModel, and further processes reload it instead of loading and
+    tracing the model
+    """
+
+    key = (os.path.abspath(filepath), tuple(shape), precision)
+
+    if not key in model_functions:
+
+        spec = tf.TensorSpec(shape, tf.float32)
+
+        if len(cache_dir) > 0:
+            # the cache is invalidated if the model file changes
+            tag = "%s-%s-%s-%s" % (key[0], os.path.getmtime(filepath), shape, precision)
+            savedpath = os.path.join(
+                cache_dir, hashlib.md5(tag.encode()).hexdigest()
+            )
+        else:
+            savedpath = ""
+
+        # the module is kept as it holds the variables used by the function
+        if (len(savedpath) > 0) and os.path.isdir(savedpath):
+            module = tf.saved_model.load(savedpath)
+        else:
+            module = tf.Module()
+            module.model = load_keras_model(filepath, precision)
+            module.predict = tf.function(
+                lambda X: tf.cast(
+                    module.model(tf.cast(X, precision), training=False), "float32"
+                ),
+                input_signature=[spec],
+            )
+            module.predict.get_concrete_function()
+            if len(savedpath) > 0:
+                tf.saved_model.save(module, savedpath)
+
+        model_functions[key] = module
+
+    return model_functions[key].predict
+
+tflite_interpreters = {}
+
+def get_tflite_function(filepath, shape, num_threads=None):
+    """
+    Return a function evaluating the TFLite model filepath on float32 inputs
+    of the given shape, the interpreter is set-up once per process and shape
+    """
+
+    key = (os.path.abspath(filepath), os.path.getmtime(filepath), tuple(shape))
+
+    if not key in tflite_interpreters:
+        interpreter = tf.lite.Interpreter(model_path=filepath, num_threads=num_threads)
+        interpreter.resize_tensor_input(
+            interpreter.get_input_details()[0]["index"], tuple(shape)
+        )
+        interpreter.allocate_tensors()
+        tflite_interpreters[key] = interpreter
+
+    interpreter = tflite_interpreters[key]
+
+    def predict(X):
+        interpreter.set_tensor(
+            interpreter.get_input_details()[0]["index"], np.asarray(X, dtype="float32")
+        )
+        interpreter.invoke()
+        return interpreter.get_tensor(interpreter.get_output_details()[0]["index"])
+
+    return predict
+
+####################################################################################
+
+class emulator_backend(abc.ABC):
+    """
+    Inference backend of an emulator of the model-lib, it loads the model of
+    the directory dirpath, normalizes (with fieldbounds) and pads (with PAD)
+    the input fields, evaluates the model on batches, and crops and
+    denormalizes the outputs. Only differentiable backends can be evaluated
+    within a tf.function or a tf.GradientTape (e.g. fused_step, optimize), and
+    only some handle the reduced precisions (option precision)
+    """
+
+    differentiable = False
+    reduced_precision = False
+
+    def __init__(
+        self, dirpath, fieldin, fieldout, fieldbounds, PAD=[[0, 0], [0, 0]], **options
+    ):
+
+        self.dirpath = dirpath
+        self.fieldin = fieldin
+        self.fieldout = fieldout
+        self.fieldbounds = fieldbounds
+        self.PAD = PAD
+        self.options = options
+
+        self.load()
+
+    @abc.abstractmethod
+    def load(self):
+        """
+        load the model
+        """
+
+    @abc.abstractmethod
+    def predict(self, X):
+        """
+        evaluate the model on a normalized and padded batch
+        """
+
+    def normalize(self, fields, shape):
+        """
+        stack the input fields, taken from the dict fields and broadcast to
+        shape (..., ny, nx), into a normalized and padded batch
+        """
+
+        return tf.stack(
+            [
+                tf.pad(
+                    tf.reshape(
+                        tf.broadcast_to(fields[f], shape), (-1,) + tuple(shape[-2:])
+                    ),
+                    [[0, 0]] + self.PAD,
+                    "CONSTANT",
+                )
+                / self.fieldbounds[f]
+                for f in self.fieldin
+            ],
+            axis=-1,
+        )
+
+    def denormalize(self, Y, shape):
+        """
+        return the list of the output fields, cropped, reshaped to shape and
+        denormalized
+        """
+
+        Ny, Nx = shape[-2:]
+
+        return [
+            tf.reshape(Y[:, :Ny, :Nx, kk], shape) * self.fieldbounds[f]
+            for kk, f in enumerate(self.fieldout)
+        ]
+
+class keras_backend(emulator_backend):
+    """
+    keras model.h5, in float32 or reduced precision (option precision)
+    """
+
+    differentiable = True
+    reduced_precision = True
+
+    def load(self):
+
+        self.filepath = os.path.join(self.dirpath, "model.h5")
+        self.precision = self.options.get("precision", "float32")
+        self.model = load_keras_model(self.filepath, self.precision)
+
+    def predict(self, X):
+
+        if tf.executing_eagerly():
+            return get_model_function(
+                self.filepath,
+                (None,) + tuple(X.shape[1:]),
+                self.options.get("cache_dir", ""),
+                self.precision,
+            )(X)
+        elif self.precision == "float32":
+            return self.model(X, training=False)
+        else:
+            return tf.cast(
+                self.model(tf.cast(X, self.precision), training=False), "float32"
+            )
+
+class savedmodel_backend(emulator_backend):
+    """
+    model.h5 exported once as SavedModel compiled with XLA, kept in the model
+    directory (or in option cache_dir), e.g. to deploy on GPU nodes
+    """
+
+    differentiable = True
+    reduced_precision = True
+
+    def load(self):
+
+        filepath = os.path.join(self.dirpath, "model.h5")
+        precision = self.options.get("precision", "float32")
+
+        cache_dir = self.options.get("cache_dir", "")
+        if len(cache_dir) == 0:
+            cache_dir = self.dirpath
+
+        # the export is invalidated if the model file changes
+        tag = "%s-%s-%s" % (os.path.abspath(filepath), os.path.getmtime(filepath), precision)
+        savedpath = os.path.join(
+            cache_dir,
+            "model-savedmodel-xla-%s-%s" % (precision, hashlib.md5(tag.encode()).hexdigest()),
+        )
+
+        if not os.path.isdir(savedpath):
+            module = tf.Module()
+            module.model = load_keras_model(filepath, precision)
+            module.predict = tf.function(
+                lambda X: tf.cast(
+                    module.model(tf.cast(X, precision), training=False), "float32"
+                ),
+                input_signature=[
+                    tf.TensorSpec((None, None, None, len(self.fieldin)), tf.float32)
+                ],
+                jit_compile=True,
+            )
+            tf.saved_model.save(module, savedpath)
+
+        self.module = tf.saved_model.load(savedpath)
+
+    def predict(self, X):
+        return self.module.predict(X)
+
+class onnx_backend(emulator_backend):
+    """
+    model.onnx evaluated with ONNX Runtime on CPU, the model is converted
+    from model.h5 with tf2onnx if missing (both packages are optional)
+    """
+
+    def load(self):
+
+        import onnxruntime
+
+        filepath = os.path.join(self.dirpath, "model.onnx")
+        h5path = os.path.join(self.dirpath, "model.h5")
+
+        # the model is converted again if model.h5 is more recent
+        if (not os.path.exists(filepath)) or (
+            os.path.exists(h5path) and (os.path.getmtime(filepath) < os.path.getmtime(h5path))
+        ):
+            import tf2onnx
+
+            tf2onnx.convert.from_keras(
+                load_keras_model(h5path),
+                input_signature=[
+                    tf.TensorSpec((None, None, None, len(self.fieldin)), tf.float32)
+                ],
+                output_path=filepath,
+            )
+
+        options = onnxruntime.SessionOptions()
+        if self.options.get("num_threads", None) is not None:
+            options.intra_op_num_threads = self.options["num_threads"]
+
+        self.session = onnxruntime.InferenceSession(
+            filepath, options, providers=["CPUExecutionProvider"]
+        )
+        self.input_name = self.session.get_inputs()[0].name
+
+    def predict(self, X):
+        return self.session.run(
+            None, {self.input_name: np.asarray(X, dtype="float32")}
+        )[0]
+
+class tflite_backend(emulator_backend):
+    """
+    quantized model-<quantize_mode>.tflite produced by run_quantize
+    """
+
+    def load(self):
+
+        self.filepath = os.path.join(
+            self.dirpath,
+            "model-" + self.options.get("quantize_mode", "dynamic") + ".tflite",
+        )
+
+        assert os.path.exists(self.filepath)
+
+    def predict(self, X):
+        return get_tflite_function(
+            self.filepath, X.shape, self.options.get("num_threads", None)
+        )(X)
+
+emulator_backends = {
+    "keras": keras_backend,
+    "savedmodel": savedmodel_backend,
+    "onnx": onnx_backend,
+    "tflite": tflite_backend,
+}
+
+####################################################################################
+
 class igm:
 
     ####################################################################################
@@ -60,10 +702,6 @@ class igm:
         self.parser = argparse.ArgumentParser(description="IGM")
         self.read_config_param()
         self.config = self.parser.parse_args()
-        
-        config = tf.compat.v1.ConfigProto()
-        config.gpu_options.allow_growth = True
-        session = tf.compat.v1.Session(config=config)
 
     def read_config_param(self):
 
@@ -76,6 +714,13 @@ class igm:
         self.parser.add_argument(
             "--resample", type=int, default=1, help="Upsample the data from geology.nc"
         )
+        self.parser.add_argument(
+            "--ncdf_vars_to_load",
+            type=str,
+            nargs="+",
+            default=[],
+            help="Variables loaded from the input NetCDF files in addition to those the enabled components need (see ncdf_vars_needed), all if 'all' ([])",
+        )
         self.parser.add_argument(
             "--tstart", type=float, default=0.0, help="Starting time"
         )
@@ -113,6 +758,24 @@ class igm:
             default=True,
             help="Use the GPU for ice flow model (True)",
         )
+        self.parser.add_argument(
+            "--num_threads_intra",
+            type=int,
+            default=0,
+            help="Number of threads used by TensorFlow within operations, 0 keeps the default (0)",
+        )
+        self.parser.add_argument(
+            "--num_threads_inter",
+            type=int,
+            default=0,
+            help="Number of threads used by TensorFlow across operations, 0 keeps the default (0)",
+        )
+        self.parser.add_argument(
+            "--jit_compile",
+            type=str2bool,
+            default=False,
+            help="XLA-compile the emulator (with its pre-processing) and the transport for the static grid shape (False)",
+        )
         self.parser.add_argument(
             "--stop",
             type=str2bool,
@@ -167,6 +830,15 @@ class igm:
             "+++++++++++++++++++ START IGM ++++++++++++++++++++++++++++++++++++++++++"
         )
 
+        # This is used to limite the number of used core to 1 (or user-defined),
+        # which must be done before TensorFlow creates its context
+        set_num_threads(self.config.num_threads_intra, self.config.num_threads_inter)
+
+        config = tf.compat.v1.ConfigProto()
+        config.gpu_options.allow_growth = True
+        session = tf.compat.v1.Session(config=config)
+
+        self.scheduler = scheduler(self.config.tstart)
         self.t = tf.Variable(float(self.config.tstart))
         self.it = 0
         self.dt = float(self.config.dtmax)
@@ -177,6 +849,9 @@ class igm:
         self.tcomp = {}
         self.tcomp["All"] = []
 
+        # one-time costs, e.g. model loading and warm-up, reported apart
+        self.tinit = {}
+
         self.device_name = "/GPU:0" * self.config.usegpu + "/CPU:0" * (
             not self.config.usegpu
         )
@@ -188,10 +863,6 @@ class igm:
         else:
             os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
-        # This is used to limite the number of used core to 1 (or user-defined)
-        #        tf.config.threading.set_inter_op_parallelism_threads(1)  # another method
-        #        tf.config.threading.set_intra_op_parallelism_threads(1)  # another method
-
         with open(
             os.path.join(self.config.working_dir, "igm-run-parameters.txt"), "w"
         ) as f:
@@ -207,33 +878,118 @@ class igm:
         if self.config.verbosity == 1:
             print("LOAD NCDF file")
 
-        nc = Dataset(os.path.join(self.config.working_dir, filename), "r")
+        with ncdf_lock:
+            nc = Dataset(os.path.join(self.config.working_dir, filename), "r")
 
-        x = np.squeeze(nc.variables["x"]).astype("float32")
-        y = np.squeeze(nc.variables["y"]).astype("float32")
-        assert x[1] - x[0] == y[1] - y[0]
+            # resampling keeps every resample-th node, which is read directly from the file
+            r = self.config.resample
 
-        for var in nc.variables:
-            if not var in ["x", "y"]:
-                vars()[var] = np.squeeze(nc.variables[var]).astype("float32")
-                vars()[var] = np.where(vars()[var] > 10 ** 35, np.nan, vars()[var])
+            x = np.squeeze(nc.variables["x"][::r]).astype("float32")
+            y = np.squeeze(nc.variables["y"][::r]).astype("float32")
+            assert x[1] - x[0] == y[1] - y[0]
 
-        if self.config.resample > 1:
-            xx = x[:: self.config.resample]
-            yy = y[:: self.config.resample]
-            for var in nc.variables:
-                if not var in ["x", "y"]:
-                    vars()[var] = RectBivariateSpline(y, x, vars()[var])(yy, xx)
-            x = xx
-            y = yy
+            self.x = tf.constant(x)
+            self.y = tf.constant(y)
 
-        for var in nc.variables:
-            if var in ["x", "y"]:
-                vars(self)[var] = tf.constant(vars()[var].astype("float32"))
+            if "all" in self.config.ncdf_vars_to_load:
+                needed = list(nc.variables)
             else:
-                vars(self)[var] = tf.Variable(vars()[var].astype("float32"))
+                needed = self.ncdf_vars_needed(filename)
+
+            names = [v for v in nc.variables if (v in needed) & (not v in ["x", "y"])]
+            skipped = [v for v in nc.variables if not v in names + ["x", "y"]]
+
+            t0 = time.time()
+
+            for var in names:
+
+                t0 = time.time()
+
+                t1 = time.time()
+
+                vars(self)[var] = tf.Variable(self.read_ncdf_variable(nc.variables[var], r))
+
+                if self.config.verbosity == 1:
+                    print(
+                        "   %-20s %8.2f Mbytes  %8.4f s"
+                        % (var, vars(self)[var].shape.num_elements() * 4 / 10 ** 6, time.time() - t1)
+                    )
+
+            nc.close()
+
+        print(
+            "Loaded %d variables of %s (%.2f Mbytes, %.3f s)"
+            % (
+                len(names),
+                filename,
+                sum(vars(self)[v].shape.num_elements() * 4 for v in names) / 10 ** 6,
+                time.time() - t0,
+            )
+            + (", not needed : " + " ".join(skipped) if len(skipped) > 0 else "")
+        )
+
+    def ncdf_vars_needed(self, filename):
+        """
+        return the variables of the input NetCDF file filename the run needs: the
+        fields igm initializes from the inputs (see initialize_fields), the
+        observations if optimizing or reading the observation file, those returned
+        by the methods ncdf_vars_<type_climate> and ncdf_vars_<type_mass_balance>
+        if they exist, the variables to save and plot, and ncdf_vars_to_load
+        """
+
+        names = [
+            "thk", "usurf", "topg", "icemask", "mask", "usurfobs", "uvelsurf",
+            "vvelsurf", "wvelbase", "wvelsurf", "smb", "mb", "dhdt", "strflowctrl",
+            "arrhenius", "slidingco",
+        ]
+
+        if self.config.optimize | (filename == self.config.observation_file):
+            names += [
+                "thkobs", "thkinit", "icemaskobs", "uvelsurfobs", "vvelsurfobs",
+                "divfluxobs",
+            ]
+
+        for name in [self.config.type_climate, self.config.type_mass_balance]:
+            if hasattr(self, "ncdf_vars_" + name):
+                names += getattr(self, "ncdf_vars_" + name)()
+
+        return (
+            names
+            + list(self.config.vars_to_save)
+            + [self.config.varplot]
+            + list(self.config.ncdf_vars_to_load)
+        )
+
+    def read_ncdf_variable(self, variable, r=1):
+        """
+        read a variable of a NetCDF file as float32 array, with stride r along the
+        two last axes, and nan where values are missing (fill or missing value, or
+        above 10**35), without copying the data once read in float32
+        """
+
+        # the masking and scaling of netCDF4 are done here in place
+        variable.set_auto_maskandscale(False)
+
+        if variable.ndim >= 2:
+            data = np.squeeze(variable[..., ::r, ::r])
+        else:
+            data = np.squeeze(variable[...])
+
+        missing = data > 10 ** 35
+        for name in ["_FillValue", "missing_value"]:
+            if name in variable.ncattrs():
+                missing |= np.isin(data, getattr(variable, name))
 
-        nc.close()
+        data = data.astype("float32", copy=False)
+
+        if "scale_factor" in variable.ncattrs():
+            data *= np.float32(variable.scale_factor)
+        if "add_offset" in variable.ncattrs():
+            data += np.float32(variable.add_offset)
+
+        data[missing] = np.nan
+
+        return data
 
     def initialize_fields(self):
         """
@@ -306,17 +1062,20 @@ class igm:
 
         self.dx = self.x[1] - self.x[0]
 
-        self.slopsurfx, self.slopsurfy = self.compute_gradient_tf(
-            self.usurf, self.dx, self.dx
-        )
-
         self.ubar = tf.Variable(tf.zeros_like(self.thk))
         self.vbar = tf.Variable(tf.zeros_like(self.thk))
         self.uvelbase = tf.Variable(tf.zeros_like(self.thk))
         self.vvelbase = tf.Variable(tf.zeros_like(self.thk))
         self.divflux = tf.Variable(tf.zeros_like(self.thk))
 
-        self.var_info = {}
+        if self.config.ensemble_size > 0:
+            self.initialize_ensemble()
+
+        self.slopsurfx, self.slopsurfy = self.compute_gradient_tf(
+            self.usurf, self.dx, self.dx
+        )
+
+        self.var_info = {}
         self.var_info["topg"] = ["Basal Topography", "m"]
         self.var_info["usurf"] = ["Surface Topography", "m"]
         self.var_info["thk"] = ["Ice Thickness", "m"]
@@ -356,21 +1115,22 @@ class igm:
         if self.config.verbosity == 1:
             print("READ RESTARTING FILE, OVERIDE FIELDS WHEN GIVEN")
 
-        nc = Dataset(self.config.restartingfile, "r")
+        with ncdf_lock:
+            nc = Dataset(self.config.restartingfile, "r")
 
-        Rx = tf.constant(np.squeeze(nc.variables["x"]).astype("float32"))
-        Ry = tf.constant(np.squeeze(nc.variables["y"]).astype("float32"))
+            Rx = tf.constant(np.squeeze(nc.variables["x"]).astype("float32"))
+            Ry = tf.constant(np.squeeze(nc.variables["y"]).astype("float32"))
 
-        assert Rx.shape == self.x.shape
-        assert Ry.shape == self.y.shape
+            assert Rx.shape == self.x.shape
+            assert Ry.shape == self.y.shape
 
-        for var in nc.variables:
-            if not var in ["x", "y"]:
-                vars(self)[var].assign(
-                    np.squeeze(nc.variables[var][-1]).astype("float32")
-                )
+            for var in nc.variables:
+                if not var in ["x", "y"]:
+                    vars(self)[var].assign(
+                        np.squeeze(nc.variables[var][-1]).astype("float32")
+                    )
 
-        nc.close()
+            nc.close()
 
     def stop(self):
         """
@@ -384,6 +1144,97 @@ class igm:
         s = float(n.size * n.itemsize) / (10 ** 6)
         print("%1.0f Mbytes" % s)
 
+    ####################################################################################
+    ####################################################################################
+    ####################################################################################
+    #                               ENSEMBLE
+    ####################################################################################
+    ####################################################################################
+    ####################################################################################
+
+    def read_config_param_ensemble(self):
+
+        self.parser.add_argument(
+            "--ensemble_size",
+            type=int,
+            default=0,
+            help="Number of members run at once, the fields then get a leading member dimension, active if > 0",
+        )
+        self.parser.add_argument(
+            "--ensemble_params",
+            type=json.loads,
+            default={},
+            help="Values of the perturbed parameters for each member, in json, e.g. '{\"init_arrhenius\": [60, 78, 100], \"mb_scaling\": [0.9, 1, 1.1]}', the parameters being init_arrhenius, init_slidingco, init_strflowctrl, mb_scaling, and those listed by ensemble_params_<type_mass_balance> ({})",
+        )
+
+    def initialize_ensemble(self):
+        """
+        replicate the evolving fields along a leading member dimension, such that
+        all members are evolved together and pass through the emulator as one
+        batch, fields that are common to all members (topg, icemask) remain 2D
+        """
+
+        if self.config.verbosity == 1:
+            print("Initialize ensemble of size : ", self.config.ensemble_size)
+
+        N = self.config.ensemble_size
+
+        # these components do not handle the member dimension yet
+        assert not self.config.tracking_particles
+        assert not self.config.vel3d_active
+        assert not self.config.optimize
+        assert not self.config.update_topg
+        assert not self.config.type_mass_balance == "nn"
+
+        # parameters read through get_param, the mass balance listing its own ones
+        supported = ["init_arrhenius", "init_slidingco", "init_strflowctrl", "mb_scaling"]
+        name = "ensemble_params_" + self.config.type_mass_balance
+        if hasattr(self, name):
+            supported += getattr(self, name)()
+
+        self.ensemble_param = {}
+        for p, values in self.config.ensemble_params.items():
+            assert p in supported, "parameter %s can not vary among the members" % p
+            assert len(values) == N
+            self.ensemble_param[p] = np.reshape(np.array(values, dtype="float32"), (N, 1, 1))
+
+        for f in [
+            "thk",
+            "usurf",
+            "smb",
+            "dhdt",
+            "strflowctrl",
+            "arrhenius",
+            "slidingco",
+            "uvelsurf",
+            "vvelsurf",
+            "wvelbase",
+            "wvelsurf",
+            "ubar",
+            "vbar",
+            "uvelbase",
+            "vvelbase",
+            "divflux",
+        ]:
+            vars(self)[f] = tf.Variable(tf.stack([vars(self)[f]] * N))
+
+        for f in ["strflowctrl", "arrhenius", "slidingco"]:
+            if "init_" + f in self.ensemble_param:
+                vars(self)[f].assign(
+                    tf.ones_like(vars(self)[f]) * self.ensemble_param["init_" + f]
+                )
+
+    def get_param(self, name):
+        """
+        return the parameter name, with shape (N,1,1) if it is perturbed among
+        the N members of the ensemble, or its value in config otherwise
+        """
+
+        if hasattr(self, "ensemble_param") and (name in self.ensemble_param):
+            return self.ensemble_param[name]
+        else:
+            return getattr(self.config, name)
+
     ####################################################################################
     ####################################################################################
     ####################################################################################
@@ -407,6 +1258,159 @@ class igm:
             ],
             help="List of variables to be recorded in the ncdef file",
         )
+        self.parser.add_argument(
+            "--ncdf_buffer_size",
+            type=int,
+            default=1,
+            help="Number of snapshots buffered in memory before writing them at once in the ncdf files, which are therefore flushed every ncdf_buffer_size saves, at the end of the run and at exit (1)",
+        )
+        self.parser.add_argument(
+            "--ncdf_zlib",
+            type=str2bool,
+            default=False,
+            help="Compress the variables of ex.nc and ex3d.nc with zlib (False)",
+        )
+        self.parser.add_argument(
+            "--ncdf_complevel",
+            type=int,
+            default=4,
+            help="zlib compression level between 1 and 9 (4)",
+        )
+        self.parser.add_argument(
+            "--ncdf_shuffle",
+            type=str2bool,
+            default=True,
+            help="Apply the HDF5 shuffle filter before compression (True)",
+        )
+        self.parser.add_argument(
+            "--ncdf_least_significant_digit",
+            type=int,
+            default=None,
+            help="Quantize the saved variables to this number of decimals, improves compression (None)",
+        )
+        self.parser.add_argument(
+            "--ncdf_encoding",
+            type=json.loads,
+            default={},
+            help="Per-variable settings overriding the above, in json, e.g. '{\"thk\": {\"least_significant_digit\": 1}, \"U\": {\"pack_range\": [-1000, 1000]}}'; pack_range stores the variable as int16, chunksizes sets the chunk shape ({})",
+        )
+        self.parser.add_argument(
+            "--ncdf_async",
+            type=str2bool,
+            default=False,
+            help="Write the outputs (ncdf, trajectories) from a background thread (False)",
+        )
+        self.parser.add_argument(
+            "--ncdf_queue_size",
+            type=int,
+            default=4,
+            help="Maximum number of pending output tasks before the time loop waits for the writer thread (4)",
+        )
+
+    def submit_output(self, func, *args):
+        """
+        Run an output task, or hand it over to the background writer thread if
+        ncdf_async is True. Tasks are executed in order, and the call blocks
+        when ncdf_queue_size tasks are already pending (back-pressure)
+        """
+
+        if not self.config.ncdf_async:
+            func(*args)
+            return
+
+        if not hasattr(self, "output_thread"):
+            self.output_queue = queue.Queue(maxsize=max(self.config.ncdf_queue_size, 1))
+            self.output_error = None
+            self.output_thread = threading.Thread(target=self.output_worker, daemon=True)
+            self.output_thread.start()
+            atexit.register(self.drain_output)
+
+        if self.output_error is not None:
+            raise self.output_error
+
+        self.output_queue.put((func, args))
+
+    def output_worker(self):
+        """
+        Loop of the background writer thread, a None task stops it
+        """
+
+        while True:
+            task = self.output_queue.get()
+            if task is None:
+                self.output_queue.task_done()
+                break
+            func, args = task
+            try:
+                if self.output_error is None:
+                    func(*args)
+            except Exception as e:
+                self.output_error = e
+            self.output_queue.task_done()
+
+    def drain_output(self):
+        """
+        Wait until all pending output tasks are done and stop the writer thread
+        """
+
+        if hasattr(self, "output_thread"):
+            self.output_queue.put(None)
+            self.output_thread.join()
+            atexit.unregister(self.drain_output)
+            del self.output_thread
+            if self.output_error is not None:
+                raise self.output_error
+
+    def ncdf_encoding(self, var, shape):
+        """
+        Return the compression, quantization, packing and chunking settings of
+        the saved variable var, whose snapshots have the given shape. Chunks
+        are (1, ny, nx) horizontal slabs, which match how the snapshots are
+        written and usually read
+        """
+
+        encoding = {
+            "zlib": self.config.ncdf_zlib,
+            "complevel": self.config.ncdf_complevel,
+            "shuffle": self.config.ncdf_shuffle,
+            "chunksizes": (1,) * (len(shape) - 1) + tuple(shape[-2:]),
+        }
+
+        if self.config.ncdf_least_significant_digit is not None:
+            encoding["least_significant_digit"] = self.config.ncdf_least_significant_digit
+
+        encoding.update(self.config.ncdf_encoding.get(var, {}))
+
+        return encoding
+
+    def init_ncdf_writer(self, name, filename, coords, variables):
+        """
+        Create the ncdf output file 'filename', with coordinates and variables
+        given as lists of arguments of ncdf_writer.add_coordinate/add_variable
+        """
+
+        if not hasattr(self, "ncdf_writers"):
+            self.ncdf_writers = {}
+            # make sure buffered records reach the disk even if run() is not completed
+            atexit.register(self.close_ncdf)
+
+        writer = ncdf_writer(
+            os.path.join(self.config.working_dir, filename),
+            self.config.ncdf_buffer_size,
+        )
+        for coord in coords:
+            writer.add_coordinate(*coord)
+        for variable in variables:
+            writer.add_variable(*variable)
+
+        self.ncdf_writers[name] = writer
+
+    def append_ncdf_writer(self, name, t, fields, flush=False):
+
+        self.ncdf_writers[name].append(t, fields)
+
+        if flush:
+            self.ncdf_writers[name].flush()
 
     def update_ncdf_ex(self, force=False):
         """
@@ -430,70 +1434,46 @@ class igm:
             if "velbase_mag" in self.config.vars_to_save:
                 self.velbase_mag = self.getmag(self.uvelbase, self.vvelbase)
 
-            if "meanprec" in self.config.vars_to_save:
-                self.meanprec = tf.math.reduce_mean(self.precipitation, axis=0)
+            if ("meanprec" in self.config.vars_to_save) | (
+                "meantemp" in self.config.vars_to_save
+            ):
+                self.meantemp, self.meanprec = self.climate_means()
 
-            if "meantemp" in self.config.vars_to_save:
-                self.meantemp = tf.math.reduce_mean(self.air_temp, axis=0)
-
-            if self.it == 0:
+            if not hasattr(self, "already_initialized_ncdf_ex"):
 
                 if self.config.verbosity == 1:
                     print("Initialize NCDF output Files")
 
-                nc = Dataset(
-                    os.path.join(self.config.working_dir, "ex.nc"),
-                    "w",
-                    format="NETCDF4",
-                )
-
-                nc.createDimension("time", None)
-                E = nc.createVariable("time", np.dtype("float32").char, ("time",))
-                E.units = "yr"
-                E.long_name = "time"
-                E.axis = "T"
-                E[0] = self.t.numpy()
-
-                nc.createDimension("y", len(self.y))
-                E = nc.createVariable("y", np.dtype("float32").char, ("y",))
-                E.units = "m"
-                E.long_name = "y"
-                E.axis = "Y"
-                E[:] = self.y.numpy()
-
-                nc.createDimension("x", len(self.x))
-                E = nc.createVariable("x", np.dtype("float32").char, ("x",))
-                E.units = "m"
-                E.long_name = "x"
-                E.axis = "X"
-                E[:] = self.x.numpy()
-
-                for var in self.config.vars_to_save:
-
-                    E = nc.createVariable(
-                        var, np.dtype("float32").char, ("time", "y", "x")
-                    )
-                    E.long_name = self.var_info[var][0]
-                    E.units = self.var_info[var][1]
-                    E[0, :, :] = vars(self)[var].numpy()
-
-                nc.close()
-
-            else:
-
-                nc = Dataset(
-                    os.path.join(self.config.working_dir, "ex.nc"),
-                    "a",
-                    format="NETCDF4",
+                self.submit_output(
+                    self.init_ncdf_writer,
+                    "ex",
+                    "ex.nc",
+                    self.ncdf_member_coordinate()
+                    + [
+                        ("y", self.y.numpy(), "m", "Y"),
+                        ("x", self.x.numpy(), "m", "X"),
+                    ],
+                    [
+                        (
+                            var,
+                            ("member", "y", "x")[-len(vars(self)[var].shape) :],
+                            self.var_info[var][0],
+                            self.var_info[var][1],
+                            None,
+                            self.ncdf_encoding(var, vars(self)[var].shape),
+                        )
+                        for var in self.config.vars_to_save
+                    ],
                 )
-
-                d = nc.variables["time"][:].shape[0]
-                nc.variables["time"][d] = self.t.numpy()
-
-                for var in self.config.vars_to_save:
-                    nc.variables[var][d, :, :] = vars(self)[var].numpy()
-
-                nc.close()
+                self.already_initialized_ncdf_ex = True
+
+            self.submit_output(
+                self.append_ncdf_writer,
+                "ex",
+                self.scheduler.t,
+                {var: vars(self)[var].numpy() for var in self.config.vars_to_save},
+                self.scheduler.t >= self.config.tend,
+            )
 
             self.tcomp["Outputs ncdf"][-1] -= time.time()
             self.tcomp["Outputs ncdf"][-1] *= -1
@@ -508,47 +1488,76 @@ class igm:
 
         if force | self.saveresult:
 
-            vol = np.sum(self.thk) * (self.dx ** 2) / 10 ** 9
-            area = np.sum(self.thk > 1) * (self.dx ** 2) / 10 ** 6
+            # one value per member in case of ensemble
+            vol = np.sum(self.thk, axis=(-2, -1)) * (self.dx ** 2) / 10 ** 9
+            area = np.sum(self.thk > 1, axis=(-2, -1)) * (self.dx ** 2) / 10 ** 6
 
-            if self.it == 0:
+            if not hasattr(self, "already_initialized_ncdf_ts"):
 
                 if self.config.verbosity == 1:
                     print("Initialize NCDF output Files")
 
-                nc = Dataset(
-                    os.path.join(self.config.working_dir, "ts.nc"),
-                    "w",
-                    format="NETCDF4",
+                self.submit_output(
+                    self.init_ncdf_writer,
+                    "ts",
+                    "ts.nc",
+                    self.ncdf_member_coordinate(),
+                    [
+                        (
+                            var,
+                            ("member",)[: len(vol.shape)],
+                            self.var_info[var][0],
+                            self.var_info[var][1],
+                        )
+                        for var in ["vol", "area"]
+                    ],
                 )
+                self.already_initialized_ncdf_ts = True
+
+            self.submit_output(
+                self.append_ncdf_writer,
+                "ts",
+                self.scheduler.t,
+                {"vol": np.float32(vol), "area": np.float32(area)},
+                self.scheduler.t >= self.config.tend,
+            )
 
-                nc.createDimension("time", None)
-                E = nc.createVariable("time", np.dtype("float32").char, ("time",))
-                E.units = "yr"
-                E.long_name = "time"
-                E.axis = "T"
-                E[0] = self.t.numpy()
-
-                for var in ["vol", "area"]:
-                    E = nc.createVariable(var, np.dtype("float32").char, ("time"))
-                    E[0] = vars()[var].numpy()
-                    E.long_name = self.var_info[var][0]
-                    E.units = self.var_info[var][1]
-                nc.close()
-
-            else:
+    def ncdf_member_coordinate(self):
+        """
+        return the member coordinate of the ncdf outputs in case of ensemble
+        """
 
-                nc = Dataset(
-                    os.path.join(self.config.working_dir, "ts.nc"),
-                    "a",
-                    format="NETCDF4",
+        if self.config.ensemble_size > 0:
+            return [
+                (
+                    "member",
+                    np.arange(self.config.ensemble_size),
+                    "1",
+                    "E",
+                    "realization",
                 )
-                d = nc.variables["time"][:].shape[0]
+            ]
+        else:
+            return []
 
-                nc.variables["time"][d] = self.t.numpy()
-                for var in ["vol", "area"]:
-                    nc.variables[var][d] = vars()[var].numpy()
-                nc.close()
+    def close_ncdf(self):
+        """
+        Complete the pending output tasks, flush the buffered records and
+        close all ncdf output files
+        """
+
+        self.drain_output()
+
+        if hasattr(self, "ncdf_writers"):
+            for writer in self.ncdf_writers.values():
+                writer.close()
+            atexit.unregister(self.close_ncdf)
+            del self.ncdf_writers
+
+        # a further run creates new files
+        for name in ["ex", "ts", "3d_ex"]:
+            if hasattr(self, "already_initialized_ncdf_" + name):
+                delattr(self, "already_initialized_ncdf_" + name)
 
     ####################################################################################
     ####################################################################################
@@ -562,7 +1571,10 @@ class igm:
 
         # NUMERICL PARAMETER FOR TIME STEP
         self.parser.add_argument(
-            "--cfl", type=float, default=0.3, help="CFL number must be below 1 (0.3)"
+            "--cfl",
+            type=float,
+            default=0.3,
+            help="CFL number, must be below 1 with the upwind transport_scheme, 0.5 with tvd, can exceed 1 with implicit at the cost of accuracy (0.3)",
         )
         self.parser.add_argument(
             "--dtmax",
@@ -576,7 +1588,7 @@ class igm:
         compute time step to satisfy the CLF condition and hit requested saving times
         """
         if self.config.verbosity == 1:
-            print("Update DT from the CFL condition at time : ", self.t.numpy())
+            print("Update DT from the CFL condition at time : ", self.scheduler.t)
 
         if not hasattr(self, "already_called_update_t_dt"):
             self.tcomp["Time step"] = []
@@ -590,26 +1602,32 @@ class igm:
         else:
             self.tcomp["Time step"].append(time.time())
     
-            velomax = max(
-                tf.math.reduce_max(tf.math.abs(self.ubar)),
-                tf.math.reduce_max(tf.math.abs(self.vbar)),
+            # the only transfer from the device in the time step control
+            velomax = tf.math.reduce_max(
+                tf.maximum(tf.math.abs(self.ubar), tf.math.abs(self.vbar))
             ).numpy()
     
             if velomax > 0:
-                self.dt_target = min(self.config.cfl * self.dx / velomax, self.config.dtmax)
+                # dx is a tensor, the time step is kept as a host float
+                self.dt_target = min(
+                    float(self.config.cfl * self.dx / velomax) * self.dt_multirate_factor(),
+                    self.config.dtmax,
+                )
             else:
                 self.dt_target = self.config.dtmax
     
             self.dt = self.dt_target
     
-            if self.tsave[self.itsave + 1] <= self.t.numpy() + self.dt:
-                self.dt = self.tsave[self.itsave + 1] - self.t.numpy()
-                self.t.assign(self.tsave[self.itsave + 1])
+            if self.tsave[self.itsave + 1] <= self.scheduler.t + self.dt:
+                self.dt = self.tsave[self.itsave + 1] - self.scheduler.t
+                self.scheduler.t = self.tsave[self.itsave + 1]
                 self.saveresult = True
                 self.itsave += 1
             else:
-                self.t.assign(self.t.numpy() + self.dt)
+                self.scheduler.t += self.dt
                 self.saveresult = False
+
+            self.t.assign(self.scheduler.t)
     
             self.it += 1
     
@@ -629,10 +1647,7 @@ class igm:
         """
         return the norm of a 2D vector, e.g. to compute velbase_mag
         """
-        return tf.norm(
-            tf.concat([tf.expand_dims(u, axis=-1), tf.expand_dims(v, axis=-1)], axis=2),
-            axis=2,
-        )
+        return tf.norm(tf.stack([u, v], axis=-1), axis=-1)
 
     @tf.function()
     def compute_gradient_tf(self, s, dx, dy):
@@ -640,11 +1655,15 @@ class igm:
         compute spatial 2D gradient of a given field
         """
 
-        EX = tf.concat([s[:, 0:1], 0.5 * (s[:, :-1] + s[:, 1:]), s[:, -1:]], 1)
-        diffx = (EX[:, 1:] - EX[:, :-1]) / dx
+        EX = tf.concat(
+            [s[..., :, 0:1], 0.5 * (s[..., :, :-1] + s[..., :, 1:]), s[..., :, -1:]], -1
+        )
+        diffx = (EX[..., :, 1:] - EX[..., :, :-1]) / dx
 
-        EY = tf.concat([s[0:1, :], 0.5 * (s[:-1, :] + s[1:, :]), s[-1:, :]], 0)
-        diffy = (EY[1:, :] - EY[:-1, :]) / dy
+        EY = tf.concat(
+            [s[..., 0:1, :], 0.5 * (s[..., :-1, :] + s[..., 1:, :]), s[..., -1:, :]], -2
+        )
+        diffy = (EY[..., 1:, :] - EY[..., :-1, :]) / dy
 
         return diffx, diffy
 
@@ -701,6 +1720,91 @@ class igm:
             default=0,
             help="This permits to artificially upper-bound velocities, active if > 0",
         )
+        self.parser.add_argument(
+            "--iceflow_backend",
+            type=str,
+            default="keras",
+            help="Inference backend of the emulator: keras, savedmodel (exported with XLA), onnx (ONNX Runtime CPU), or tflite (quantized model-<quantize_mode>.tflite produced by run_quantize)",
+        )
+        self.parser.add_argument(
+            "--quantize_mode",
+            type=str,
+            default="dynamic",
+            help="Quantization of the emulator, dynamic (int8 weights) or int8 (int8 weights and activations, calibrated)",
+        )
+        self.parser.add_argument(
+            "--quantize_calibration_files",
+            type=str,
+            nargs="+",
+            default=[],
+            help="Files (with thk and usurf) from which the calibration and validation samples of the quantization are drawn, geology_file if empty",
+        )
+        self.parser.add_argument(
+            "--quantize_samples",
+            type=int,
+            default=100,
+            help="Number of samples drawn for the quantization, half for calibration, half for validation (100)",
+        )
+        self.parser.add_argument(
+            "--quantize_crop_size",
+            type=int,
+            default=64,
+            help="Size (in grid cells) of the samples drawn for the quantization (64)",
+        )
+        self.parser.add_argument(
+            "--iceflow_precision",
+            type=str,
+            default="float32",
+            help="Precision of the emulator inference, float32, bfloat16 (fast on CPU with AVX512-BF16/AMX) or float16 (fast on GPU)",
+        )
+        self.parser.add_argument(
+            "--iceflow_precision_tol",
+            type=float,
+            default=0.05,
+            help="Maximum error on ubar and vbar of the reduced precision emulator relative to float32 (checked at the first step), above which float32 is used (0.05)",
+        )
+        self.parser.add_argument(
+            "--iceflow_model_cache_dir",
+            type=str,
+            default="",
+            help="Directory where to keep the traced emulator as SavedModel, such that further runs skip the tracing (only worth for large emulators), not used if empty",
+        )
+        self.parser.add_argument(
+            "--iceflow_tile_size",
+            type=int,
+            default=0,
+            help="Evaluate the emulator by tiles of this size (in grid cells) to bound the memory, active if > 0",
+        )
+        self.parser.add_argument(
+            "--iceflow_tile_halo",
+            type=int,
+            default=16,
+            help="Overlap (in grid cells) added on each side of the tiles, should cover the receptive field of the emulator (16)",
+        )
+        self.parser.add_argument(
+            "--iceflow_tile_batch",
+            type=int,
+            default=8,
+            help="Number of tiles passed at once through the emulator (8)",
+        )
+        self.parser.add_argument(
+            "--iceflow_skip_icefree",
+            type=str2bool,
+            default=False,
+            help="Evaluate the emulator only on tiles that contain ice, requires iceflow_tile_size > 0 (False)",
+        )
+        self.parser.add_argument(
+            "--iceflow_update_freq",
+            type=int,
+            default=1,
+            help="Update the ice flow each X time steps, the transport sub-cycles in between with the last velocities (1)",
+        )
+        self.parser.add_argument(
+            "--iceflow_update_thr",
+            type=float,
+            default=0,
+            help="Update the ice flow before iceflow_update_freq time steps if the relative ice thickness change since the last update exceeds this threshold, active if > 0",
+        )
 
     def initialize_iceflow(self):
         """
@@ -718,14 +1822,7 @@ class igm:
         self.iceflow_mapping["fieldout"] = fieldout
         self.iceflow_fieldbounds = fieldbounds
 
-        self.iceflow_model = tf.keras.models.load_model(
-            os.path.join(dirpath, "model.h5")
-        )
-
-        #        print(self.iceflow_model.summary())
-
-        Ny = self.thk.shape[0]
-        Nx = self.thk.shape[1]
+        Ny, Nx = self.thk.shape[-2:]
 
         if self.config.multiple_window_size > 0:
             NNy = self.config.multiple_window_size * math.ceil(
@@ -738,65 +1835,487 @@ class igm:
         else:
             self.PAD = [[0, 0], [0, 0]]
 
-    def update_iceflow(self):
+        start = time.time()
+
+        self.iceflow_precision = self.config.iceflow_precision
+        self.iceflow_backend = self.create_iceflow_backend(self.iceflow_precision)
+
+        # e.g. the tflite and onnx backends evaluate the model as converted
+        assert (self.iceflow_precision == "float32") | self.iceflow_backend.reduced_precision
+
+        # only differentiable backends can be evaluated within a tf.function
+        assert (not self.config.fused_step) | self.iceflow_backend.differentiable
+        assert (not self.config.jit_compile) | self.iceflow_backend.differentiable
+
+        # XLA needs static shapes, which the tiles do not have
+        assert (not self.config.jit_compile) | (self.config.iceflow_tile_size == 0)
+
+        if self.config.jit_compile:
+            # the compiled kernels read and re-assign (not re-define) the slopes
+            self.slopsurfx = tf.Variable(self.slopsurfx)
+            self.slopsurfy = tf.Variable(self.slopsurfy)
+
+        self.tinit["Model loading"] = time.time() - start
+
+        assert (not self.config.iceflow_skip_icefree) | (
+            self.config.iceflow_tile_size > 0
+        )
+
+        self.it_last_iceflow = self.it
+        self.thk_last_iceflow = tf.Variable(self.thk)
+
+        # trace and run the emulator once, such that the first time step does
+        # not pay the tracing and the set-up of the kernels
+        self.iceflow_precision_checked = self.iceflow_precision == "float32"
+
+        start = time.time()
+        if self.config.jit_compile:
+            self.iceflow_predict_jit(self.iceflow_precision)
+        else:
+            self.iceflow_predict(self.iceflow_input())
+        self.tinit["Warm-up"] = time.time() - start
+
+    def check_iceflow_precision(self, X, Y):
         """
-        function update the ice flow using the neural network emulator
+        compare ubar and vbar of the reduced precision emulator (Y) with the
+        float32 ones at the first evaluation with ice, and fall back to float32
+        if the error relative to the maximum velocity exceeds
+        iceflow_precision_tol, return the output to be used
         """
 
-        if self.config.verbosity == 1:
-            print("Update ICEFLOW at time : ", igm.t)
+        if not tf.math.reduce_any(self.thk > 0):
+            return Y
 
-        if not hasattr(self, "already_called_update_iceflow"):
-  
-            self.tcomp["Ice flow"] = []
-            self.already_called_update_iceflow = True
-            self.initialize_iceflow()
-            
-        self.tcomp["Ice flow"].append(time.time())
-        
-        X = tf.expand_dims(
-            tf.stack(
-                [
-                    tf.pad(vars(self)[f], self.PAD, "CONSTANT")
-                    / self.iceflow_fieldbounds[f]
-                    for f in self.iceflow_mapping["fieldin"]
-                ],
-                axis=-1,
-            ),
-            axis=0,
-        )
+        backend = self.iceflow_backend
+        self.iceflow_backend = self.create_iceflow_backend("float32")
+        Yref = self.iceflow_predict(X)
 
-        Y = self.iceflow_model.predict_on_batch(X)
+        Ny, Nx = self.thk.shape[-2:]
+        mask = tf.reshape(self.thk > 0, (-1, Ny, Nx))
 
-        Ny, Nx = self.thk.shape
+        err = 0.0
+        ref = 1.0  # m/y
         for kk, f in enumerate(self.iceflow_mapping["fieldout"]):
-            vars(self)[f].assign(
-                tf.where(self.thk > 0, Y[0, :Ny, :Nx, kk], 0)
-                * self.iceflow_fieldbounds[f]
-            )
+            if f in ["ubar", "vbar"]:
+                D = tf.where(mask, Y[:, :Ny, :Nx, kk] - Yref[:, :Ny, :Nx, kk], 0)
+                R = tf.where(mask, Yref[:, :Ny, :Nx, kk], 0)
+                err = max(err, float(tf.reduce_max(tf.abs(D))) * self.iceflow_fieldbounds[f])
+                ref = max(ref, float(tf.reduce_max(tf.abs(R))) * self.iceflow_fieldbounds[f])
 
-        if self.config.force_max_velbar > 0:
+        print(
+            "Ice flow emulator in %s : relative error on ubar, vbar = %.2e"
+            % (self.iceflow_precision, err / ref)
+        )
 
-            self.velbar_mag = self.getmag(self.ubar, self.vbar)
+        self.iceflow_precision_checked = True
 
-            self.ubar.assign(
-                tf.where(
-                    self.velbar_mag >= self.config.force_max_velbar,
-                    self.config.force_max_velbar * (self.ubar / self.velbar_mag),
-                    self.ubar,
+        if err / ref > self.config.iceflow_precision_tol:
+            print("Error above iceflow_precision_tol, the emulator falls back to float32")
+            self.iceflow_precision = "float32"
+            return Yref
+        else:
+            self.iceflow_backend = backend
+            return Y
+
+    def create_iceflow_backend(self, precision):
+        """
+        set-up the inference backend of the iceflow emulator
+        """
+
+        return emulator_backends[self.config.iceflow_backend](
+            os.path.join(self.config.iceflow_model_lib_path, str(int(self.dx))),
+            self.iceflow_mapping["fieldin"],
+            self.iceflow_mapping["fieldout"],
+            self.iceflow_fieldbounds,
+            self.PAD,
+            precision=precision,
+            cache_dir=self.config.iceflow_model_cache_dir,
+            num_threads=self.backend_num_threads(),
+            quantize_mode=self.config.quantize_mode,
+        )
+
+    def iceflow_input(self):
+        """
+        stack the input fields of the emulator, padded and normalized, the
+        batch dimension holds the members in case of ensemble
+        """
+
+        return self.iceflow_backend.normalize(vars(self), self.thk.shape)
+
+    @tf.function(jit_compile=True)
+    def iceflow_predict_jit(self, precision):
+        """
+        padding, stacking, normalization and evaluation of the emulator in one
+        XLA-compiled kernel, specialized (and cached by tf.function) for the
+        grid shape, precision is the one of the emulator, the kernel is
+        re-traced if it changes
+        """
+
+        return self.iceflow_predict_batch(self.iceflow_input())
+
+    def iceflow_predict(self, X):
+        """
+        evaluate the emulator on X, at once or by tiles if iceflow_tile_size > 0
+        """
+
+        if self.config.iceflow_tile_size > 0:
+            return self.iceflow_predict_tiled(X)
+        else:
+            return self.iceflow_predict_batch(X)
+
+    def iceflow_predict_batch(self, X):
+        """
+        evaluate the emulator on a batch, eagerly or within a tf.function
+        """
+
+        return self.iceflow_backend.predict(X)
+
+    def iceflow_predict_tiled(self, X):
+        """
+        pass the windows of X (tiles overlapping by iceflow_tile_halo cells) by
+        batches of iceflow_tile_batch through the emulator, and write the interior
+        of the tiles into a preallocated output, such that only the windows of one
+        batch are held in addition to the input and output fields
+        """
+
+        H = self.config.iceflow_tile_halo
+
+        # the window (tile + halo) must be a multiple of multiple_window_size
+        W = self.config.iceflow_tile_size + 2 * H
+        if self.config.multiple_window_size > 0:
+            W = self.config.multiple_window_size * math.ceil(
+                W / self.config.multiple_window_size
+            )
+        T = W - 2 * H
+
+        B, Ny, Nx, C = X.shape
+        nty = math.ceil(Ny / T)
+        ntx = math.ceil(Nx / T)
+        nb = self.config.iceflow_tile_batch
+
+        X = tf.pad(
+            X,
+            [[0, 0], [H, H + nty * T - Ny], [H, H + ntx * T - Nx], [0, 0]],
+            "CONSTANT",
+        )
+
+        # the output is allocated once (at the first, eager, call) for this shape
+        shape = (B, nty * T, ntx * T, len(self.iceflow_mapping["fieldout"]))
+        if (not hasattr(self, "iceflow_tiled_output")) or (
+            tuple(self.iceflow_tiled_output.shape) != shape
+        ):
+            self.iceflow_tiled_output = tf.Variable(tf.zeros(shape), trainable=False)
+        Y = self.iceflow_tiled_output
+
+        # index (member, tile row, tile column) of the tiles
+        tiles = tf.reshape(
+            tf.stack(
+                tf.meshgrid(tf.range(B), tf.range(nty), tf.range(ntx), indexing="ij"),
+                axis=-1,
+            ),
+            (-1, 3),
+        )
+
+        if self.config.iceflow_skip_icefree:
+
+            # the active tiles are those with ice in their interior, as the
+            # emulator output is anyway set to zero where there is no ice
+            ithk = self.iceflow_mapping["fieldin"].index("thk")
+            ice = X[:, H : H + nty * T, H : H + ntx * T, ithk] > 0
+            active = tf.math.reduce_any(tf.reshape(ice, (B, nty, T, ntx, T)), axis=(2, 4))
+            tiles = tf.gather_nd(tiles, tf.where(tf.reshape(active, [-1])))
+
+            Y.assign(tf.zeros(shape))
+
+        def window(o, size):
+            # gather indices of the windows of given size starting at the tile origins
+            s = tf.stack([tf.shape(o)[0], size, size])
+            r = tf.range(size)
+            return tf.stack(
+                [
+                    tf.broadcast_to(o[:, 0, None, None], s),
+                    tf.broadcast_to(o[:, 1, None, None] * T + r[None, :, None], s),
+                    tf.broadcast_to(o[:, 2, None, None] * T + r[None, None, :], s),
+                ],
+                axis=-1,
+            )
+
+        def body(k):
+            o = tiles[k * nb : (k + 1) * nb]
+            Yk = self.iceflow_predict_batch(tf.gather_nd(X, window(o, W)))
+            Y.scatter_nd_update(window(o, T), Yk[:, H : H + T, H : H + T, :])
+            return (k + 1,)
+
+        # a loop (and not an unrolled one within the fused graph) over the batches
+        tf.while_loop(lambda k: k * nb < tf.shape(tiles)[0], body, (tf.constant(0),))
+
+        return Y[:, :Ny, :Nx, :]
+
+    def iceflow_output(self, Y):
+        """
+        assign the output of the emulator to the fields, cropped and denormalized
+        """
+
+        for f, field in zip(
+            self.iceflow_mapping["fieldout"],
+            self.iceflow_backend.denormalize(Y, self.thk.shape),
+        ):
+            vars(self)[f].assign(tf.where(self.thk > 0, field, 0))
+
+        if self.config.force_max_velbar > 0:
+
+            velbar_mag = self.getmag(self.ubar, self.vbar)
+
+            self.ubar.assign(
+                tf.where(
+                    velbar_mag >= self.config.force_max_velbar,
+                    self.config.force_max_velbar * (self.ubar / velbar_mag),
+                    self.ubar,
                 )
             )
             self.vbar.assign(
                 tf.where(
-                    self.velbar_mag >= self.config.force_max_velbar,
-                    self.config.force_max_velbar * (self.vbar / self.velbar_mag),
+                    velbar_mag >= self.config.force_max_velbar,
+                    self.config.force_max_velbar * (self.vbar / velbar_mag),
                     self.vbar,
                 )
             )
 
+    def update_iceflow(self):
+        """
+        function update the ice flow using the neural network emulator
+        """
+
+        if self.config.verbosity == 1:
+            print("Update ICEFLOW at time : ", self.scheduler.t)
+
+        if not hasattr(self, "already_called_update_iceflow"):
+  
+            self.tcomp["Ice flow"] = []
+            self.already_called_update_iceflow = True
+
+            # the emulator is already set-up in case of optimization
+            if not hasattr(self, "iceflow_backend"):
+                self.initialize_iceflow()
+
+        elif not self.iceflow_update_due():
+            return
+
+        self.tcomp["Ice flow"].append(time.time())
+
+        if self.config.jit_compile & self.iceflow_precision_checked:
+
+            Y = self.iceflow_predict_jit(self.iceflow_precision)
+
+        else:
+
+            X = self.iceflow_input()
+
+            Y = self.iceflow_predict(X)
+
+            if not self.iceflow_precision_checked:
+                Y = self.check_iceflow_precision(X, Y)
+
+        self.iceflow_output(Y)
+
+        self.it_last_iceflow = self.it
+        if self.config.iceflow_update_thr > 0:
+            self.thk_last_iceflow.assign(self.thk)
+
         self.tcomp["Ice flow"][-1] -= time.time()
         self.tcomp["Ice flow"][-1] *= -1
 
+    def iceflow_update_due(self):
+        """
+        tell whether the emulator must be re-evaluated, or if the transport
+        can sub-cycle on the last ubar and vbar
+        """
+
+        if (self.it - self.it_last_iceflow) >= self.config.iceflow_update_freq:
+            return True
+
+        if self.config.iceflow_update_thr > 0:
+            return (
+                self.iceflow_thk_change().numpy() > self.config.iceflow_update_thr
+            )
+
+        return False
+
+    def iceflow_thk_change(self):
+        """
+        relative ice thickness change since the last update of the ice flow
+        """
+
+        return tf.math.reduce_sum(
+            tf.math.abs(self.thk - self.thk_last_iceflow)
+        ) / tf.maximum(tf.math.reduce_sum(self.thk_last_iceflow), 1.0)
+
+    def backend_num_threads(self):
+        """
+        number of threads of the TFLite and ONNX Runtime backends
+        """
+
+        if self.config.num_threads_intra > 0:
+            return self.config.num_threads_intra
+        else:
+            return backend_threads
+
+    def quantize_iceflow_model(self):
+        """
+        convert the iceflow emulator into a TFLite model, quantized with int8
+        weights (dynamic), or with int8 weights and activations (int8)
+        calibrated on samples drawn from quantize_calibration_files. The model
+        is saved as model-<quantize_mode>.tflite next to model.h5, and the
+        error against the float model is reported for each output field
+        """
+
+        dirpath = os.path.join(self.config.iceflow_model_lib_path, str(int(self.dx)))
+
+        assert os.path.isdir(dirpath)
+
+        fieldin, fieldout, fieldbounds = self.read_fields_and_bounds(dirpath)
+
+        model = load_keras_model(os.path.join(dirpath, "model.h5"))
+
+        files = self.config.quantize_calibration_files
+        if len(files) == 0:
+            files = [self.config.geology_file]
+
+        samples = self.draw_calibration_samples(files, fieldin, fieldbounds)
+
+        # even samples serve for calibration, odd ones for validation
+        calib = samples[::2]
+        valid = samples[1::2]
+
+        def representative_dataset():
+            for X in calib:
+                yield [X[None]]
+
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+        if self.config.quantize_mode == "int8":
+            converter.representative_dataset = representative_dataset
+            converter.target_spec.supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+        else:
+            assert self.config.quantize_mode == "dynamic"
+
+        filepath = os.path.join(dirpath, "model-" + self.config.quantize_mode + ".tflite")
+
+        with open(filepath, "wb") as f:
+            f.write(converter.convert())
+
+        predict = get_tflite_function(
+            filepath, (1,) + valid.shape[1:], self.backend_num_threads()
+        )
+
+        Y = np.concatenate([predict(X[None]) for X in valid])
+        Yref = get_model_function(
+            os.path.join(dirpath, "model.h5"), (None,) + valid.shape[1:]
+        )(valid).numpy()
+
+        with open(
+            os.path.join(
+                self.config.working_dir,
+                "quantize-" + self.config.quantize_mode + "-validation.txt",
+            ),
+            "w",
+        ) as f:
+            print("Quantized emulator : ", filepath)
+            print("Quantized emulator : ", filepath, file=f)
+            for kk, v in enumerate(fieldout):
+                D = (Y[..., kk] - Yref[..., kk]) * fieldbounds[v]
+                R = Yref[..., kk] * fieldbounds[v]
+                CELA = (
+                    v,
+                    np.sqrt(np.mean(D ** 2)),
+                    np.max(np.abs(D)),
+                    np.sqrt(np.mean(D ** 2)) / max(np.sqrt(np.mean(R ** 2)), 1.0e-10),
+                )
+                print(
+                    "     %15s  |  rms error : %8.4f  |  max error : %8.4f  |  relative rms error : %8.4f"
+                    % CELA
+                )
+                print(
+                    "     %15s  |  rms error : %8.4f  |  max error : %8.4f  |  relative rms error : %8.4f"
+                    % CELA,
+                    file=f,
+                )
+
+    def draw_calibration_samples(self, files, fieldin, fieldbounds):
+        """
+        draw quantize_samples crops of the normalized emulator inputs from the
+        given files, centered on the ice if any, the slopes are derived from
+        usurf, and the inputs missing in the files (e.g. arrhenius) are drawn
+        as random constants within their bounds
+        """
+
+        rng = np.random.default_rng(0)
+
+        maps = []
+        for filename in files:
+
+            with ncdf_lock:
+                nc = Dataset(os.path.join(self.config.working_dir, filename), "r")
+
+                x = np.squeeze(nc.variables["x"]).astype("float32")
+
+                fields = {}
+                for var in nc.variables:
+                    if not var in ["x", "y"]:
+                        field = np.ma.filled(np.squeeze(nc.variables[var][:]), np.nan)
+                        field = field.astype("float32")
+                        fields[var] = np.where(np.isnan(field) | (field > 10 ** 35), 0, field)
+
+                nc.close()
+
+            for var, alts in [("thk", ["thkobs", "thkinit"]), ("usurf", ["usurfobs"])]:
+                for alt in alts:
+                    if (not var in fields) & (alt in fields):
+                        fields[var] = fields[alt]
+
+            if not "thk" in fields:
+                fields["thk"] = np.zeros_like(fields["usurf"])
+
+            slopsurfx, slopsurfy = self.compute_gradient_tf(
+                fields["usurf"], x[1] - x[0], x[1] - x[0]
+            )
+            fields["slopsurfx"] = slopsurfx.numpy()
+            fields["slopsurfy"] = slopsurfy.numpy()
+
+            maps.append(fields)
+
+        C = min([self.config.quantize_crop_size] + [min(m["thk"].shape) for m in maps])
+
+        samples = []
+        for i in range(self.config.quantize_samples):
+
+            fields = maps[i % len(maps)]
+            Ny, Nx = fields["thk"].shape
+
+            J, I = np.nonzero(fields["thk"] > 0)
+            if len(J) > 0:
+                k = rng.integers(len(J))
+                j, i = J[k], I[k]
+            else:
+                j, i = rng.integers(Ny), rng.integers(Nx)
+
+            j = min(max(j - C // 2, 0), Ny - C)
+            i = min(max(i - C // 2, 0), Nx - C)
+
+            samples.append(
+                np.stack(
+                    [
+                        fields[f][j : j + C, i : i + C] / fieldbounds[f]
+                        if f in fields
+                        else np.full((C, C), rng.uniform(), dtype="float32")
+                        for f in fieldin
+                    ],
+                    axis=-1,
+                )
+            )
+
+        return np.stack(samples).astype("float32")
+
     ####################################################################################
     ####################################################################################
     ####################################################################################
@@ -818,7 +2337,50 @@ class igm:
             "--type_climate",
             type=str,
             default="",
-            help="toy or any custom climate",
+            help="toy, gridded or any custom climate",
+        )
+        self.parser.add_argument(
+            "--clim_gridded_file",
+            type=str,
+            default="climate.nc",
+            help="NetCDF file of the gridded climate, with coordinates x, y (in the projection of igm) and time (in years) (climate.nc)",
+        )
+        self.parser.add_argument(
+            "--clim_gridded_vars",
+            type=str,
+            nargs=2,
+            default=["air_temp", "precipitation"],
+            help="Names of the variables of air temperature (°C) and precipitation in the gridded climate file (air_temp, precipitation)",
+        )
+        self.parser.add_argument(
+            "--clim_gridded_prec_factor",
+            type=float,
+            default=1.0,
+            help="Factor converting the gridded precipitation to m ice eq. / y (1.0)",
+        )
+        self.parser.add_argument(
+            "--clim_gridded_steps",
+            type=int,
+            default=12,
+            help="Number of time slices per year in the gridded climate file (12)",
+        )
+        self.parser.add_argument(
+            "--clim_gridded_elevation",
+            type=str,
+            default="",
+            help="Name of the variable of the elevation of the gridded climate, if given the temperature is corrected with clim_gridded_lapse_rate to usurf ()",
+        )
+        self.parser.add_argument(
+            "--clim_gridded_lapse_rate",
+            type=float,
+            default=-0.0065,
+            help="Temperature lapse rate in °C/m applied to the gridded climate (-0.0065)",
+        )
+        self.parser.add_argument(
+            "--clim_gridded_window",
+            type=int,
+            default=120,
+            help="Number of time slices of the gridded climate kept in memory, the following ones being read in the background (120)",
         )
 
     def update_climate(self, force=False):
@@ -828,120 +2390,584 @@ class igm:
 
         if len(self.config.type_climate) > 0:
 
-            if not hasattr(self, "already_called_update_climate"):
+            if not hasattr(self, "already_called_update_climate"):
+
+                getattr(self, "load_climate_data_" + self.config.type_climate)()
+                self.scheduler.register("climate", self.config.clim_update_freq)
+                self.tcomp["Climate"] = []
+                self.already_called_update_climate = True
+
+            if self.scheduler.due("climate", force):
+
+                if self.config.verbosity == 1:
+                    print("Construct climate at time : ", self.scheduler.t)
+
+                self.tcomp["Climate"].append(time.time())
+
+                getattr(self, "update_climate_" + self.config.type_climate)()
+
+                self.tcomp["Climate"][-1] -= time.time()
+                self.tcomp["Climate"][-1] *= -1
+
+    # A climate module either stores the fields air_temp and precipitation with shape
+    # (nt,ny,nx), nt being the number of climate steps in the year (e.g. 365 or 12), or
+    # the series station_temp and station_prec with shape (nt,) with the corrections
+    # temp_corr_addi and prec_corr_mult with shape (ny,nx), the fields being then
+    # evaluated on demand by broadcasting, such that nothing of size nt*ny*nx is stored
+
+    def climate_steps(self):
+        """
+        number of climate steps in the year
+        """
+
+        if hasattr(self, "station_temp"):
+            return self.station_temp.shape[0]
+        else:
+            return self.air_temp.shape[0]
+
+    def climate_fields(self, k):
+        """
+        return the air temperature and precipitation fields at the climate step k
+        """
+
+        return self.climate_step(self.climate_state(), k)
+
+    def climate_state(self, index=None):
+        """
+        return the climate in compact form, to be evaluated with climate_step, the
+        spatial fields being averaged over the elevation bands if their index is given
+        """
+
+        def reduce(field):
+            return field if index is None else self.band_mean(field, index)
+
+        if hasattr(self, "station_temp"):
+            return (
+                self.station_temp,
+                self.station_prec,
+                reduce(self.temp_corr_addi),
+                reduce(self.prec_corr_mult),
+            )
+        else:
+            return (reduce(self.air_temp), reduce(self.precipitation))
+
+    def climate_step(self, climate, k):
+        """
+        return the air temperature and precipitation at the climate step k
+        """
+
+        if len(climate) == 4:
+            station_temp, station_prec, temp_corr_addi, prec_corr_mult = climate
+            return (
+                station_temp[k] + temp_corr_addi,
+                tf.clip_by_value(station_prec[k] * prec_corr_mult, 0, 10 ** 10),
+            )
+        else:
+            air_temp, precipitation = climate
+            return air_temp[k], precipitation[k]
+
+    def climate_means(self):
+        """
+        return the mean anual air temperature and precipitation fields
+        """
+
+        if hasattr(self, "station_temp"):
+            # the precipitation of the station is non-negative
+            return (
+                tf.math.reduce_mean(self.station_temp) + self.temp_corr_addi,
+                tf.math.reduce_mean(self.station_prec) * tf.maximum(self.prec_corr_mult, 0),
+            )
+        else:
+            return (
+                tf.math.reduce_mean(self.air_temp, axis=0),
+                tf.math.reduce_mean(self.precipitation, axis=0),
+            )
+
+    def regridding_weights(self, xs, ys):
+        """
+        return the bilinear interpolation from the grid of coordinates xs, ys onto the
+        grid of igm as sparse matrix of shape (ny*nx, nys*nxs), values beyond the source
+        grid being extrapolated as constant. The weights are cached in the working dir
+        """
+
+        x = self.x.numpy().astype("float64")
+        y = self.y.numpy().astype("float64")
+
+        key = hashlib.md5()
+        for c in [xs, ys, x, y]:
+            key.update(np.ascontiguousarray(c, dtype="float64").tobytes())
+        filename = os.path.join(
+            self.config.working_dir, "regrid-" + key.hexdigest() + ".npz"
+        )
+
+        if os.path.exists(filename):
+            w = np.load(filename)
+            indices, values = w["indices"], w["values"]
+
+        else:
+
+            assert (len(xs) > 1) & (len(ys) > 1)
+
+            def weights(c, cs):
+                # the source coordinates may be decreasing (e.g. latitudes)
+                order = np.argsort(cs)
+                cs = cs[order]
+                i = np.clip(np.searchsorted(cs, c, side="right") - 1, 0, len(cs) - 2)
+                w = np.clip((c - cs[i]) / (cs[i + 1] - cs[i]), 0, 1)
+                return order[i], order[i + 1], w
+
+            i0, i1, wx = weights(x, xs)
+            j0, j1, wy = weights(y, ys)
+
+            # the four neighbours of each cell of igm, with row-major indexing
+            J, I = np.meshgrid(np.arange(len(y)), np.arange(len(x)), indexing="ij")
+            rows = np.repeat((J * len(x) + I).reshape(-1), 4)
+            cols = np.stack(
+                [
+                    j0[J] * len(xs) + i0[I],
+                    j0[J] * len(xs) + i1[I],
+                    j1[J] * len(xs) + i0[I],
+                    j1[J] * len(xs) + i1[I],
+                ],
+                axis=-1,
+            ).reshape(-1)
+            values = np.stack(
+                [
+                    (1 - wy[J]) * (1 - wx[I]),
+                    (1 - wy[J]) * wx[I],
+                    wy[J] * (1 - wx[I]),
+                    wy[J] * wx[I],
+                ],
+                axis=-1,
+            ).reshape(-1).astype("float32")
+            indices = np.stack([rows, cols], axis=-1).astype("int64")
+
+            # written aside first, as other processes may read the directory
+            np.savez(filename + ".tmp.npz", indices=indices, values=values)
+            os.replace(filename + ".tmp.npz", filename)
+
+        return tf.sparse.reorder(
+            tf.SparseTensor(indices, values, [len(y) * len(x), len(ys) * len(xs)])
+        )
+
+    def regrid(self, fields):
+        """
+        regrid fields of shape (L,nys,nxs) onto the grid of igm, as sparse matmul
+        """
+
+        L = fields.shape[0]
+        X = tf.transpose(tf.reshape(tf.constant(fields, dtype="float32"), [L, -1]))
+        Y = tf.sparse.sparse_dense_matmul(self.regridding_matrix, X)
+
+        return tf.reshape(tf.transpose(Y), [L] + self.usurf.shape)
+
+    def load_climate_data_gridded(self):
+        """
+        open the gridded climate, compute the regridding weights and initialize the
+        fields air_temp and precipitation, of shape (clim_gridded_steps,ny,nx)
+        """
+
+        assert len(self.usurf.shape) == 2
+
+        filename = os.path.join(self.config.working_dir, self.config.clim_gridded_file)
+
+        with ncdf_lock:
+            nc = Dataset(filename, "r")
+            xs = np.squeeze(nc.variables["x"]).astype("float64")
+            ys = np.squeeze(nc.variables["y"]).astype("float64")
+            if len(self.config.clim_gridded_elevation) > 0:
+                zs = np.ma.filled(nc.variables[self.config.clim_gridded_elevation][:], np.nan)
+            nc.close()
+
+        self.regridding_matrix = self.regridding_weights(xs, ys)
+
+        # elevation of the gridded climate on the grid of igm, for the lapse rate
+        if len(self.config.clim_gridded_elevation) > 0:
+            self.clim_gridded_zs = self.regrid(np.reshape(zs, (1,) + zs.shape))[0]
+
+        # each variable is read by windows of time slices, the next one being
+        # read in the background while the current one is used
+        self.clim_gridded = [
+            forcing_reader(filename, var, window=self.config.clim_gridded_window)
+            for var in self.config.clim_gridded_vars
+        ]
+
+        nt = self.config.clim_gridded_steps
+
+        self.air_temp = tf.Variable(tf.zeros([nt] + self.usurf.shape), dtype="float32")
+        self.precipitation = tf.Variable(tf.zeros([nt] + self.usurf.shape), dtype="float32")
+
+    def update_climate_gridded(self):
+        """
+        regrid the time slices of the current year of the gridded climate
+        """
+
+        year = math.floor(self.scheduler.t)
+        temp, prec = [r.get(year, year + 1) for r in self.clim_gridded]
+
+        assert temp.shape[0] == self.config.clim_gridded_steps
+        assert prec.shape[0] == self.config.clim_gridded_steps
+
+        air_temp = self.regrid(temp)
+        if len(self.config.clim_gridded_elevation) > 0:
+            air_temp += self.config.clim_gridded_lapse_rate * (
+                self.usurf - self.clim_gridded_zs
+            )
+
+        self.air_temp.assign(air_temp)
+        self.precipitation.assign(
+            tf.maximum(self.regrid(prec) * self.config.clim_gridded_prec_factor, 0)
+        )
+
+    ####################################################################################
+    ####################################################################################
+    ####################################################################################
+    #                                 MASS BALANCE
+    ####################################################################################
+    ####################################################################################
+    ####################################################################################
+
+    def read_config_param_smb(self):
+
+        self.parser.add_argument(
+            "--mb_update_freq",
+            type=float,
+            default=1,
+            help="Update the mass balance each X years (1)",
+        )
+        self.parser.add_argument(
+            "--type_mass_balance",
+            type=str,
+            default="simple",
+            help="zero, simple, given",
+        )
+        self.parser.add_argument(
+            "--mb_scaling", type=float, default=1.0, help="mass balance scaling"
+        )
+        self.parser.add_argument(
+            "--ela_shift",
+            type=float,
+            default=0.0,
+            help="Shift of the ELA of the simple mass balance (0)",
+        )
+        self.parser.add_argument(
+            "--mb_simple_file",
+            type=str,
+            default="mb_simple_param.txt",
+            help="mb_simple_file",
+        )
+        self.parser.add_argument(
+            "--smb_simple_batch",
+            type=int,
+            default=1,
+            help="Number of updates of the simple mass balance computed at once, at the times t+k*mb_update_freq with the surface at time t (frozen over the batch), 1 disables it (1)",
+        )
+        self.parser.add_argument(
+            "--smb_backend",
+            type=str,
+            default="keras",
+            help="Inference backend of the smb emulator: keras, savedmodel, onnx, or tflite",
+        )
+        self.parser.add_argument(
+            "--smb_precision",
+            type=str,
+            default="float32",
+            help="Precision of the inference of the smb emulator, float32, bfloat16 or float16",
+        )
+        self.parser.add_argument(
+            "--smb_model_lib_path",
+            type=str,
+            default="/home/jouvetg/IGM/model-lib/smb_meteoswissglamos",
+            help="Model directory in case the smb model in use is 'nn'for neural netowrk",
+        )
+        self.parser.add_argument(
+            "--smb_cache_size",
+            type=int,
+            default=0,
+            help="Number of smb fields (or of the inputs the smb model computes them from) kept in a LRU cache shared by the runs of the process, keyed by the smb parameters and the quantized surface, 0 disables it (0)",
+        )
+        self.parser.add_argument(
+            "--smb_cache_quantum",
+            type=float,
+            default=1.0,
+            help="Surfaces equal up to this value (m) share the same cached smb (1.0)",
+        )
+        self.parser.add_argument(
+            "--smb_cache_dir",
+            type=str,
+            default="",
+            help="Directory where the cached smb fields are also stored as npy files for other runs, e.g. of a calibration sweep (none by default)",
+        )
+        self.parser.add_argument(
+            "--smb_elevation_bands",
+            type=int,
+            default=0,
+            help="Number of elevation bands over which climate-driven smb models (e.g. accmelt) are evaluated instead of every cell, the smb being then interpolated in elevation, 0 disables it (0)",
+        )
+        self.parser.add_argument(
+            "--smb_band_classes",
+            type=int,
+            default=1,
+            help="Number of classes of equal size each spatial map the smb model depends on (e.g. snow redistribution, radiation) is split into within the elevation bands (1)",
+        )
+
+    def smb_cache_key(self):
+        """
+        key of the smb cache, made of the parameters returned by the method
+        smb_cache_params_<type_mass_balance> if it exists (the whole config and
+        the time otherwise), and of the surface quantized with smb_cache_quantum
+        """
+
+        name = "smb_cache_params_" + self.config.type_mass_balance
+
+        if hasattr(self, name):
+            params = getattr(self, name)()
+        else:
+            params = (sorted(vars(self.config).items()), self.scheduler.t)
+
+        key = hashlib.md5(repr((self.config.type_mass_balance, params)).encode())
+        key.update(
+            np.round(self.usurf.numpy() / self.config.smb_cache_quantum)
+            .astype("int32")
+            .tobytes()
+        )
+
+        return key.hexdigest()
+
+    def elevation_bands(self, maps=None):
+        """
+        split the range of usurf into smb_elevation_bands bands of equal height, each
+        being split further into classes of equal size of the spatial maps the smb
+        depends on (smb_band_classes per map), return the band index of each cell (band
+        times number of classes plus class), the mean elevation of each band (or its
+        center if empty) and the number of cells of each band
+        """
+
+        if maps is None:
+            maps = []
+
+        K = self.config.smb_elevation_bands
+        M = self.config.smb_band_classes
+
+        assert K > 1
+        assert len(self.usurf.shape) == 2
+
+        zmin = tf.math.reduce_min(self.usurf)
+        zmax = tf.math.reduce_max(self.usurf)
+        dz = tf.maximum(zmax - zmin, 1.0) / K
+
+        index = tf.cast(
+            tf.clip_by_value(tf.math.floor((self.usurf - zmin) / dz), 0, K - 1), "int32"
+        )
+        center = zmin + (tf.range(K, dtype="float32") + 0.5) * dz
+
+        for m in maps:
+            sort = tf.sort(tf.reshape(m, [-1]))
+            edges = tf.gather(sort, (np.arange(1, M) * sort.shape[0]) // M)
+            cls = tf.searchsorted(edges, tf.reshape(m, [-1]), side="right")
+            index = index * M + tf.reshape(tf.cast(cls, "int32"), self.usurf.shape)
+            center = tf.repeat(center, M)
+
+        self.nbands = K * M ** len(maps)
+
+        ids = tf.reshape(index, [-1])
+        count = tf.math.unsorted_segment_sum(tf.ones_like(ids, dtype="float32"), ids, self.nbands)
+        zsum = tf.math.unsorted_segment_sum(tf.reshape(self.usurf, [-1]), ids, self.nbands)
+
+        return index, tf.where(count > 0, zsum / tf.maximum(count, 1), center), count
+
+    def band_mean(self, field, index):
+        """
+        average a field of shape (...,ny,nx) over the bands of index, the result has
+        shape (...,nbands), empty bands get the mean over all cells
+        """
+
+        ids = tf.reshape(index, [-1])
+        shape = field.shape[:-2]
+        data = tf.transpose(tf.reshape(field, [-1, ids.shape[0]]))  # has shape (ny*nx,L)
+
+        count = tf.math.unsorted_segment_sum(tf.ones_like(ids, dtype=field.dtype), ids, self.nbands)
+        mean = tf.math.unsorted_segment_sum(data, ids, self.nbands) / tf.maximum(count, 1)[:, None]
+        mean = tf.where(count[:, None] > 0, mean, tf.math.reduce_mean(data, axis=0))
+
+        return tf.reshape(tf.transpose(mean), shape + [self.nbands])
+
+    def band_interp(self, values, index, zb, count):
+        """
+        map values given per band onto the grid, with linear interpolation in usurf
+        toward the band above or below of the same class if it is not empty
+        """
+
+        C = self.nbands // self.config.smb_elevation_bands
+
+        z = tf.reshape(self.usurf, [-1])
+        ids = tf.reshape(index, [-1])
+        z0 = tf.gather(zb, ids)
+
+        # neighbour band of the same class on the side of the cell elevation
+        jds = tf.where(z > z0, ids + C, ids - C)
+        jds = tf.where((jds < 0) | (jds >= self.nbands), ids, jds)
+        ok = (tf.gather(count, jds) > 0) & (jds != ids)
+
+        z1 = tf.gather(zb, jds)
+        w = tf.where(ok, tf.clip_by_value((z - z0) / tf.where(ok, z1 - z0, 1.0), 0, 1), 0)
+
+        v = tf.gather(values, ids) * (1 - w) + tf.gather(values, jds) * w
+
+        return tf.reshape(v, self.usurf.shape)
 
-                getattr(self, "load_climate_data_" + self.config.type_climate)()
-                self.tlast_clim = -1.0e5000
-                self.tcomp["Climate"] = []
-                self.already_called_update_climate = True
+    def update_smb_cached(self):
+        """
+        update the smb with update_smb_<type_mass_balance> only if it is not
+        found in the cache (in memory, or in smb_cache_dir). A smb model may cache
+        instead the inputs that do not depend on some of its parameters, computed
+        by smb_cache_fields_<type_mass_balance> and turned into the smb by
+        smb_from_cache_fields_<type_mass_balance>, these parameters being then
+        left out of the key
+        """
 
-            new_clim_needed = (
-                self.t.numpy() - self.tlast_clim
-            ) >= self.config.clim_update_freq
+        name = self.config.type_mass_balance
 
-            if force | new_clim_needed:
+        key = self.smb_cache_key()
 
-                if self.config.verbosity == 1:
-                    print("Construct climate at time : ", igm.t)
+        if len(self.config.smb_cache_dir) > 0:
+            filename = os.path.join(self.config.smb_cache_dir, "smb-" + key + ".npy")
+        else:
+            filename = ""
 
-                self.tcomp["Climate"].append(time.time())
+        if key in smb_fields:
+            smb = smb_fields.pop(key)
 
-                getattr(self, "update_climate_" + self.config.type_climate)()
+        elif (len(filename) > 0) and os.path.exists(filename):
+            smb = np.load(filename)
 
-                self.tlast_clim = self.t.numpy()
+        else:
+            if hasattr(self, "smb_cache_fields_" + name):
+                smb = getattr(self, "smb_cache_fields_" + name)().numpy()
+            else:
+                getattr(self, "update_smb_" + name)()
+                smb = self.smb.numpy()
 
-                self.tcomp["Climate"][-1] -= time.time()
-                self.tcomp["Climate"][-1] *= -1
+            if len(filename) > 0:
+                os.makedirs(self.config.smb_cache_dir, exist_ok=True)
+                # written aside first, as other processes may read the directory
+                np.save(filename + ".tmp.npy", smb)
+                os.replace(filename + ".tmp.npy", filename)
 
-    ####################################################################################
-    ####################################################################################
-    ####################################################################################
-    #                                 MASS BALANCE
-    ####################################################################################
-    ####################################################################################
-    ####################################################################################
+        smb_fields[key] = smb
 
-    def read_config_param_smb(self):
+        while len(smb_fields) > self.config.smb_cache_size:
+            del smb_fields[next(iter(smb_fields))]
 
-        self.parser.add_argument(
-            "--mb_update_freq",
-            type=float,
-            default=1,
-            help="Update the mass balance each X years (1)",
-        )
-        self.parser.add_argument(
-            "--type_mass_balance",
-            type=str,
-            default="simple",
-            help="zero, simple, given",
-        )
-        self.parser.add_argument(
-            "--mb_scaling", type=float, default=1.0, help="mass balance scaling"
-        )
-        self.parser.add_argument(
-            "--mb_simple_file",
-            type=str,
-            default="mb_simple_param.txt",
-            help="mb_simple_file",
-        )
-        self.parser.add_argument(
-            "--smb_model_lib_path",
-            type=str,
-            default="/home/jouvetg/IGM/model-lib/smb_meteoswissglamos",
-            help="Model directory in case the smb model in use is 'nn'for neural netowrk",
-        )
+        if hasattr(self, "smb_from_cache_fields_" + name):
+            getattr(self, "smb_from_cache_fields_" + name)(smb)
+        else:
+            self.smb.assign(smb)
 
     def init_smb_simple(self):
         """
-        initialize simple mass balance
+        initialize simple mass balance, the parameter table is kept on the device
         """
         param = np.loadtxt(
             os.path.join(self.config.working_dir, self.config.mb_simple_file),
             skiprows=1,
             dtype=np.float32,
+            ndmin=2,
         )
 
-        self.gradabl = interp1d(
-            param[:, 0],
-            param[:, 1],
-            fill_value=(param[0, 1], param[-1, 1]),
-            bounds_error=False,
-        )
-        self.gradacc = interp1d(
-            param[:, 0],
-            param[:, 2],
-            fill_value=(param[0, 2], param[-1, 2]),
-            bounds_error=False,
-        )
-        self.ela = interp1d(
-            param[:, 0],
-            param[:, 3],
-            fill_value=(param[0, 3], param[-1, 3]),
-            bounds_error=False,
-        )
-        self.maxacc = interp1d(
-            param[:, 0],
-            param[:, 4],
-            fill_value=(param[0, 4], param[-1, 4]),
-            bounds_error=False,
-        )
+        # a single row gives constant parameters
+        if param.shape[0] == 1:
+            param = np.concatenate([param, param + [1, 0, 0, 0, 0]])
+
+        # columns are time, gradabl, gradacc, ela, maxacc
+        self.smb_simple_param = tf.constant(param, dtype="float64")
+
+    def ensemble_params_simple(self):
+        """
+        parameters of the simple mass balance that may vary among the members
+        """
+
+        return ["ela_shift"]
 
     def update_smb_simple(self):
         """
         mass balance 'simple' parametrized by ELA, ablation and accumulation gradients, and max acuumulation
         """
 
-        ela = np.float32(self.ela(self.t))
-        gradabl = np.float32(self.gradabl(self.t))
-        gradacc = np.float32(self.gradacc(self.t))
-        maxacc = np.float32(self.maxacc(self.t))
+        N = self.config.smb_simple_batch
+
+        if N > 1:
+            # index of the update in the current batch
+            if hasattr(self, "smb_simple_t0"):
+                k = int(np.floor((self.scheduler.t - self.smb_simple_t0) / self.config.mb_update_freq + 1.0e-6))
+            else:
+                k = -1
+
+            if (k < 0) | (k >= N):
+                self.smb_simple_t0 = self.scheduler.t
+                self.smb_simple_fields = self.compute_smb_simple(
+                    self.usurf,
+                    self.icemask,
+                    tf.constant(self.scheduler.t + self.config.mb_update_freq * np.arange(N), dtype="float64"),
+                    tf.constant(self.get_param("ela_shift"), dtype="float64"),
+                )
+                k = 0
+
+            self.smb.assign(self.smb_simple_fields[k])
+
+        else:
+            smb = self.compute_smb_simple(
+                self.usurf,
+                self.icemask,
+                tf.constant([self.scheduler.t], dtype="float64"),
+                tf.constant(self.get_param("ela_shift"), dtype="float64"),
+            )
+
+            self.smb.assign(smb[0])
+
+    @tf.function()
+    def interp_smb_simple_param(self, t):
+        """
+        linear interpolation of the simple mass balance parameters at the times t
+        (a vector), constant outside the range of the table, return gradabl,
+        gradacc, ela and maxacc
+        """
+
+        T = self.smb_simple_param[:, 0]
+
+        i = tf.clip_by_value(
+            tf.searchsorted(T, t, side="right") - 1, 0, T.shape[0] - 2
+        )
+
+        P0 = tf.gather(self.smb_simple_param, i)
+        P1 = tf.gather(self.smb_simple_param, i + 1)
+
+        w = tf.clip_by_value((t - P0[:, 0]) / (P1[:, 0] - P0[:, 0]), 0, 1)
+
+        P = P0 + w[:, None] * (P1 - P0)
+
+        return P[:, 1], P[:, 2], P[:, 3], P[:, 4]
+
+    @tf.function()
+    def compute_smb_simple(self, usurf, icemask, t, ela_shift):
+        """
+        simple mass balance at the times t (a vector), with a leading time dimension
+        """
+
+        gradabl, gradacc, ela, maxacc = self.interp_smb_simple_param(t)
+
+        S = [-1] + [1] * len(usurf.shape)
+        ela = tf.cast(tf.reshape(ela, S) + ela_shift, "float32")
+        gradabl = tf.cast(tf.reshape(gradabl, S), "float32")
+        gradacc = tf.cast(tf.reshape(gradacc, S), "float32")
+        maxacc = tf.cast(tf.reshape(maxacc, S), "float32")
 
-        smb = self.usurf - ela
+        smb = usurf - ela
         smb *= tf.where(tf.less(smb, 0), gradabl, gradacc)
         smb = tf.clip_by_value(smb, -100, maxacc)
-        smb = tf.where(self.icemask > 0.5, smb, -10)
+        smb = tf.where(icemask > 0.5, smb, -10)
 
-        self.smb.assign(smb)
+        return smb
 
     def init_smb_nn(self):
         """
@@ -961,7 +2987,17 @@ class igm:
         self.smb_mapping["fieldout"] = fieldout
         self.smb_fieldbounds = fieldbounds
 
-        self.smb_model = tf.keras.models.load_model(os.path.join(dirpath, "model.h5"))
+        self.smb_backend = emulator_backends[self.config.smb_backend](
+            dirpath,
+            fieldin,
+            fieldout,
+            fieldbounds,
+            precision=self.config.smb_precision,
+            num_threads=self.backend_num_threads(),
+            quantize_mode=self.config.quantize_mode,
+        )
+
+        assert (self.config.smb_precision == "float32") | self.smb_backend.reduced_precision
 
     def update_smb_nn(self):
         """
@@ -971,25 +3007,20 @@ class igm:
         # this is not a nice implementation, but for now, it does the job
         self.mask = tf.ones_like(self.thk)
         for i in range(12):
-            vars(self)["air_temp_" + str(i)] = self.air_temp[i]
-            vars(self)["precipitation_" + str(i)] = self.precipitation[i]
+            (
+                vars(self)["air_temp_" + str(i)],
+                vars(self)["precipitation_" + str(i)],
+            ) = self.climate_fields(i)
 
-        X = tf.expand_dims(
-            tf.stack(
-                [
-                    vars(self)[f] / self.smb_fieldbounds[f]
-                    for f in self.smb_mapping["fieldin"]
-                ],
-                axis=-1,
-            ),
-            axis=0,
-        )
+        X = self.smb_backend.normalize(vars(self), self.thk.shape)
 
-        Y = self.smb_model.predict_on_batch(X)
+        Y = self.smb_backend.predict(X)
 
         # this will return the smb, the only output of the smb nn emulator
-        for kk, f in enumerate(self.smb_mapping["fieldout"]):
-            vars(self)[f].assign(Y[0, :, :, kk] * self.smb_fieldbounds[f])
+        for f, field in zip(
+            self.smb_mapping["fieldout"], self.smb_backend.denormalize(Y, self.thk.shape)
+        ):
+            vars(self)[f].assign(field)
 
     def update_smb(self, force=False):
         """
@@ -997,32 +3028,33 @@ class igm:
         """
 
         if not hasattr(self, "already_called_update_smb"):
-            self.tlast_mb = -1.0e5000
+            self.scheduler.register("smb", self.config.mb_update_freq)
             self.tcomp["Mass balance"] = []
             if len(self.config.type_mass_balance) > 0:
                 if hasattr(self, "init_smb_" + self.config.type_mass_balance):
                     getattr(self, "init_smb_" + self.config.type_mass_balance)()
             self.already_called_update_smb = True
 
-        if (force) | ((self.t.numpy() - self.tlast_mb) >= self.config.mb_update_freq):
+        if self.scheduler.due("smb", force):
 
             if self.config.verbosity == 1:
-                print("Construct mass balance at time : ", self.t.numpy())
+                print("Construct mass balance at time : ", self.scheduler.t)
 
             self.tcomp["Mass balance"].append(time.time())
 
-            if len(self.config.type_mass_balance) > 0:
-                getattr(self, "update_smb_" + self.config.type_mass_balance)()
+            if len(self.config.type_mass_balance) == 0:
+                self.smb.assign(tf.zeros_like(self.smb))
+            elif (self.config.smb_cache_size > 0) | (len(self.config.smb_cache_dir) > 0):
+                self.update_smb_cached()
             else:
-                self.smb.assign(tf.zeros_like(self.topg))
+                getattr(self, "update_smb_" + self.config.type_mass_balance)()
 
             if hasattr(self, "icemask"):
                 self.smb.assign(self.smb * self.icemask)
 
-            if not self.config.mb_scaling == 1:
-                self.smb.assign(self.smb * self.config.mb_scaling)
-
-            self.tlast_mb = self.t.numpy()
+            mb_scaling = self.get_param("mb_scaling")
+            if np.any(mb_scaling != 1):
+                self.smb.assign(self.smb * mb_scaling)
 
             if self.config.stop:
                 mb_np = self.smb.numpy()
@@ -1076,14 +3108,18 @@ class igm:
         if self.config.erosion_include:
 
             if not hasattr(self, "already_called_update_topg"):
-                self.tlast_erosion = self.config.tstart
+                self.scheduler.register(
+                    "erosion", self.config.erosion_update_freq, self.config.tstart
+                )
                 self.tcomp["Erosion"] = []
                 self.already_called_update_topg = True
 
-            if (self.t.numpy() - self.tlast_erosion) >= self.config.erosion_update_freq:
+            tlast_erosion = self.scheduler.last["erosion"]
+
+            if self.scheduler.due("erosion"):
 
                 if self.config.verbosity == 1:
-                    print("Erode bedrock at time : ", self.t.numpy())
+                    print("Erode bedrock at time : ", self.scheduler.t)
 
                 self.tcomp["Erosion"].append(time.time())
 
@@ -1091,14 +3127,12 @@ class igm:
 
                 self.dtopgdt.assign(self.config.erosion_cst * (self.velbase_mag ** self.config.erosion_exp))
 
-                self.topg.assign(self.topg - (self.t.numpy() - self.tlast_erosion) * self.dtopgdt)
+                self.topg.assign(self.topg - (self.scheduler.t - tlast_erosion) * self.dtopgdt)
 
                 print('max erosion is :', np.max( np.abs ( self.dtopgdt ) ) )
 
                 self.usurf.assign(self.topg + self.thk)
 
-                self.tlast_erosion = self.t.numpy()
-
                 self.tcomp["Erosion"][-1] -= time.time()
                 self.tcomp["Erosion"][-1] *= -1
 
@@ -1110,39 +3144,187 @@ class igm:
     ####################################################################################
     ####################################################################################
 
+    def read_config_param_transport(self):
+
+        self.parser.add_argument(
+            "--transport_scheme",
+            type=str,
+            default="upwind",
+            help="Scheme for the ice thickness equation: upwind (explicit, first order), tvd (explicit, second order MUSCL with minmod limiter and SSP-RK2), implicit (backward Euler upwind, allows cfl above 1) or multirate (upwind with local time stepping) (upwind)",
+        )
+        self.parser.add_argument(
+            "--transport_implicit_iter",
+            type=int,
+            default=100,
+            help="Maximum number of Jacobi iterations of the implicit scheme, the steps not converged within them are reported at each save (100)",
+        )
+        self.parser.add_argument(
+            "--transport_implicit_tol",
+            type=float,
+            default=0.001,
+            help="Stop the Jacobi iterations when the thickness change is below this value in m (0.001)",
+        )
+        self.parser.add_argument(
+            "--dt_multirate_levels",
+            type=int,
+            default=4,
+            help="Number of power-of-two time step classes of the multirate transport_scheme, the time step is 2^(levels-1) times the CFL one, split in fine steps at which only the cells and edge fluxes of the classes due (according to their local velocity) are updated (4)",
+        )
+
     def update_thk(self):
         """
         update ice thickness solving dh/dt + d(u h)/dx + d(v h)/dy = f using
-        upwind finite volume, update usurf and slopes
+        the finite volume scheme transport_scheme, update usurf and slopes
         """
 
         if not hasattr(self, "already_called_update_icethickness"):
+            assert self.config.transport_scheme in ["upwind", "tvd", "implicit", "multirate"]
+            # the multirate scheme gathers a number of cells that XLA can not handle
+            assert (not self.config.jit_compile) | (self.config.transport_scheme != "multirate")
             self.tcomp["Transport"] = []
+            self.dt_class_count = tf.Variable(tf.zeros(self.config.dt_multirate_levels))
+            # number of steps where the implicit scheme did not converge, and their
+            # largest thickness change at the last iteration, reported by print_info
+            self.implicit_unconverged = tf.Variable(0)
+            self.implicit_residual = tf.Variable(0.0)
             self.already_called_update_icethickness = True
             
         else:
             if self.config.verbosity == 1:
-                print("Ice thickness equation at time : ", self.t.numpy())
+                print("Ice thickness equation at time : ", self.scheduler.t)
     
             self.tcomp["Transport"].append(time.time())
+
+            if self.config.jit_compile:
+
+                # dt is passed as a tensor to avoid re-tracing at each step
+                self.divflux = self.update_thk_jit(tf.constant(self.dt, dtype="float32"))
+
+            else:
     
-            # compute the divergence of the flux
-            self.divflux = self.compute_divflux(
-                self.ubar, self.vbar, self.thk, self.dx, self.dx
-            )
-    
-            # Forward Euler with projection to keep ice thickness non-negative
-            self.thk.assign(tf.maximum(self.thk + self.dt * (self.smb - self.divflux), 0))
-    
-            self.usurf.assign(self.topg + self.thk)
-    
-            self.slopsurfx, self.slopsurfy = self.compute_gradient_tf(
-                self.usurf, self.dx, self.dx
-            )
+                # new ice thickness and divergence of the flux with transport_scheme
+                thk, self.divflux = self.transport_step(self.dt)
+
+                self.thk.assign(thk)
+        
+                self.usurf.assign(self.topg + self.thk)
+        
+                self.slopsurfx, self.slopsurfy = self.compute_gradient_tf(
+                    self.usurf, self.dx, self.dx
+                )
+
+            if self.config.transport_scheme == "multirate":
+                self.update_dt_class_count()
     
             self.tcomp["Transport"][-1] -= time.time()
             self.tcomp["Transport"][-1] *= -1
 
+    @tf.function(jit_compile=True)
+    def update_thk_jit(self, dt):
+        """
+        divergence of the flux, thickness update, usurf and slopes in one
+        XLA-compiled kernel, return divflux
+        """
+
+        thk, divflux = self.transport_step(dt)
+
+        self.thk.assign(thk)
+
+        self.usurf.assign(self.topg + self.thk)
+
+        slopsurfx, slopsurfy = self.compute_gradient_tf(self.usurf, self.dx, self.dx)
+        self.slopsurfx.assign(slopsurfx)
+        self.slopsurfy.assign(slopsurfy)
+
+        return divflux
+
+    def transport_step(self, dt):
+        """
+        return the ice thickness after a time step dt and the divergence of the
+        flux, the ice thickness being kept non-negative by all schemes
+        """
+
+        if self.config.transport_scheme == "upwind":
+
+            divflux = self.compute_divflux(self.ubar, self.vbar, self.thk, self.dx, self.dx)
+
+            # Forward Euler with projection to keep ice thickness non-negative
+            return tf.maximum(self.thk + dt * (self.smb - divflux), 0), divflux
+
+        # dt is passed as a tensor to avoid re-tracing at each step
+        dt = tf.cast(dt, self.thk.dtype)
+
+        if self.config.transport_scheme == "tvd":
+
+            return self.compute_thk_tvd(
+                self.ubar, self.vbar, self.thk, self.smb, dt, self.dx, self.dx
+            )
+
+        elif self.config.transport_scheme == "multirate":
+
+            k = self.compute_dt_class(dt / self.dt_multirate_factor())
+
+            return self.compute_thk_multirate(
+                self.ubar, self.vbar, self.thk, self.smb, dt, k, self.dx, self.dx
+            )
+
+        else:
+
+            thk, err = self.compute_thk_implicit(
+                self.ubar, self.vbar, self.thk, self.smb, dt, self.dx, self.dx
+            )
+
+            unconverged = err > self.config.transport_implicit_tol
+            self.implicit_unconverged.assign_add(tf.cast(unconverged, "int32"))
+            self.implicit_residual.assign(
+                tf.where(unconverged, tf.maximum(self.implicit_residual, err), self.implicit_residual)
+            )
+
+            return thk, self.smb - (thk - self.thk) / dt
+
+    def dt_multirate_factor(self):
+        """
+        ratio between the time step and the CFL one, i.e. the number of fine steps
+        """
+
+        if self.config.transport_scheme == "multirate":
+            return 2 ** (self.config.dt_multirate_levels - 1)
+        else:
+            return 1
+
+    def compute_dt_class(self, dt):
+        """
+        per-cell time step class k, i.e. the cell may be advanced with steps 2^k dt,
+        from the CFL condition with the max velocity over the cell and its neighbours
+        """
+
+        velo = tf.maximum(tf.math.abs(self.ubar), tf.math.abs(self.vbar))
+
+        shape = velo.shape
+        velo = tf.nn.max_pool2d(tf.reshape(velo, [-1, shape[-2], shape[-1], 1]), 3, 1, "SAME")
+        velo = tf.reshape(velo, shape)
+
+        # zero velocity gives an infinite ratio, and therefore the largest class
+        k = tf.math.floor(tf.math.log(self.config.cfl * self.dx / (velo * dt)) / np.log(2.0))
+
+        return tf.cast(tf.clip_by_value(k, 0, self.config.dt_multirate_levels - 1), "int32")
+
+    def update_dt_class_count(self):
+        """
+        accumulate the number of ice cells in each time step class on the device,
+        reported by print_info
+        """
+
+        k = self.compute_dt_class(self.dt / self.dt_multirate_factor())
+
+        self.dt_class_count.assign_add(
+            tf.math.unsorted_segment_sum(
+                tf.reshape(tf.cast(self.thk > 0, "float32"), [-1]),
+                tf.reshape(k, [-1]),
+                self.config.dt_multirate_levels,
+            )
+        )
+
     @tf.function()
     def compute_divflux(self, u, v, h, dx, dy):
         """
@@ -1153,24 +3335,238 @@ class igm:
         #   Last, computing the divergence on the staggered grid yields values def on the original grid
         """
 
+        #   Leading dimensions (e.g. ensemble members) are left untouched
+
         ## Compute u and v on the staggered grid
         u = tf.concat(
-            [u[:, 0:1], 0.5 * (u[:, :-1] + u[:, 1:]), u[:, -1:]], 1
+            [u[..., :, 0:1], 0.5 * (u[..., :, :-1] + u[..., :, 1:]), u[..., :, -1:]], -1
         )  # has shape (ny,nx+1)
         v = tf.concat(
-            [v[0:1, :], 0.5 * (v[:-1, :] + v[1:, :]), v[-1:, :]], 0
+            [v[..., 0:1, :], 0.5 * (v[..., :-1, :] + v[..., 1:, :]), v[..., -1:, :]], -2
         )  # has shape (ny+1,nx)
 
         # Extend h with constant value at the domain boundaries
-        Hx = tf.pad(h, [[0, 0], [1, 1]], "CONSTANT")  # has shape (ny,nx+2)
-        Hy = tf.pad(h, [[1, 1], [0, 0]], "CONSTANT")  # has shape (ny+2,nx)
+        P = [[0, 0]] * (len(h.shape) - 2)
+        Hx = tf.pad(h, P + [[0, 0], [1, 1]], "CONSTANT")  # has shape (ny,nx+2)
+        Hy = tf.pad(h, P + [[1, 1], [0, 0]], "CONSTANT")  # has shape (ny+2,nx)
 
         ## Compute fluxes by selcting the upwind quantities
-        Qx = u * tf.where(u > 0, Hx[:, :-1], Hx[:, 1:])  # has shape (ny,nx+1)
-        Qy = v * tf.where(v > 0, Hy[:-1, :], Hy[1:, :])  # has shape (ny+1,nx)
+        Qx = u * tf.where(u > 0, Hx[..., :, :-1], Hx[..., :, 1:])  # has shape (ny,nx+1)
+        Qy = v * tf.where(v > 0, Hy[..., :-1, :], Hy[..., 1:, :])  # has shape (ny+1,nx)
+
+        ## Computation of the divergence, final shape is (ny,nx)
+        return (Qx[..., :, 1:] - Qx[..., :, :-1]) / dx + (
+            Qy[..., 1:, :] - Qy[..., :-1, :]
+        ) / dy
+
+    @tf.function()
+    def compute_divflux_tvd(self, u, v, h, dx, dy):
+        """
+        #   second-order upwind computation of the divergence of the flux (MUSCL)
+        #   h is reconstructed linearly in each cell with the slope limited by minmod,
+        #   the flux takes the reconstructed value on the upwind side of each edge
+        """
+
+        u = tf.concat(
+            [u[..., :, 0:1], 0.5 * (u[..., :, :-1] + u[..., :, 1:]), u[..., :, -1:]], -1
+        )  # has shape (ny,nx+1)
+        v = tf.concat(
+            [v[..., 0:1, :], 0.5 * (v[..., :-1, :] + v[..., 1:, :]), v[..., -1:, :]], -2
+        )  # has shape (ny+1,nx)
+
+        def minmod(a, b):
+            return tf.where(a * b > 0, tf.sign(a) * tf.minimum(tf.abs(a), tf.abs(b)), 0)
+
+        P = [[0, 0]] * (len(h.shape) - 2)
+        Hx = tf.pad(h, P + [[0, 0], [2, 2]], "CONSTANT")  # has shape (ny,nx+4)
+        Hy = tf.pad(h, P + [[2, 2], [0, 0]], "CONSTANT")  # has shape (ny+4,nx)
+
+        ## Limited slopes for cells -1 to n, has shape (ny,nx+2) and (ny+2,nx)
+        dHx = Hx[..., :, 1:] - Hx[..., :, :-1]
+        dHy = Hy[..., 1:, :] - Hy[..., :-1, :]
+        Sx = minmod(dHx[..., :, :-1], dHx[..., :, 1:])
+        Sy = minmod(dHy[..., :-1, :], dHy[..., 1:, :])
+
+        ## Reconstructed values on both sides of each edge
+        Hx = Hx[..., :, 1:-1]
+        Hy = Hy[..., 1:-1, :]
+        HxL = (Hx + 0.5 * Sx)[..., :, :-1]  # has shape (ny,nx+1)
+        HxR = (Hx - 0.5 * Sx)[..., :, 1:]
+        HyL = (Hy + 0.5 * Sy)[..., :-1, :]  # has shape (ny+1,nx)
+        HyR = (Hy - 0.5 * Sy)[..., 1:, :]
+
+        Qx = u * tf.where(u > 0, HxL, HxR)
+        Qy = v * tf.where(v > 0, HyL, HyR)
+
+        return (Qx[..., :, 1:] - Qx[..., :, :-1]) / dx + (
+            Qy[..., 1:, :] - Qy[..., :-1, :]
+        ) / dy
+
+    @tf.function()
+    def compute_thk_tvd(self, u, v, h, smb, dt, dx, dy):
+        """
+        two-stage strong stability preserving Runge-Kutta (SSP-RK2) with the MUSCL
+        flux, stable and total variation diminishing for cfl below 0.5,
+        return the new thickness and the mean divergence of the flux
+        """
+
+        divflux0 = self.compute_divflux_tvd(u, v, h, dx, dy)
+
+        h1 = tf.maximum(h + dt * (smb - divflux0), 0)
+
+        divflux1 = self.compute_divflux_tvd(u, v, h1, dx, dy)
+
+        h2 = tf.maximum(0.5 * h + 0.5 * (h1 + dt * (smb - divflux1)), 0)
+
+        return h2, 0.5 * (divflux0 + divflux1)
+
+    @tf.function()
+    def compute_thk_multirate(self, u, v, h, smb, dt, k, dx, dy):
+        """
+        #   upwind scheme with local time stepping over the step dt split in 2^(L-1) fine steps
+        #   a cell of class k is updated (smb, projection) every 2^k fine steps, and the flux
+        #   through an edge every 2^k fine steps, k being the smallest class of its two cells,
+        #   the flux being applied to both cells, which keeps mass conservation. The edges
+        #   and cells are sorted by class, such that those updated at a fine step are the
+        #   first ones, and only these are gathered and scattered
+        #   return the new thickness and the mean divergence of the flux
+        """
+
+        L = self.config.dt_multirate_levels
+        N = self.dt_multirate_factor()
+
+        shape = h.shape
+        n = shape.num_elements()
+
+        u = tf.concat(
+            [u[..., :, 0:1], 0.5 * (u[..., :, :-1] + u[..., :, 1:]), u[..., :, -1:]], -1
+        )  # has shape (ny,nx+1)
+        v = tf.concat(
+            [v[..., 0:1, :], 0.5 * (v[..., :-1, :] + v[..., 1:, :]), v[..., -1:, :]], -2
+        )  # has shape (ny+1,nx)
+
+        # cells on both sides of the edges, the index n standing for outside (h=0)
+        P = [[0, 0]] * (len(shape) - 2)
+        C = tf.reshape(tf.range(n), shape)
+        Cx = tf.pad(C, P + [[0, 0], [1, 1]], constant_values=n)
+        Cy = tf.pad(C, P + [[1, 1], [0, 0]], constant_values=n)
+
+        # class of the edges, the smallest of its two cells
+        Kx = tf.pad(k, P + [[0, 0], [1, 1]], "SYMMETRIC")
+        Ky = tf.pad(k, P + [[1, 1], [0, 0]], "SYMMETRIC")
+
+        def flat(x, y):
+            return tf.concat([tf.reshape(x, [-1]), tf.reshape(y, [-1])], 0)
+
+        ke = flat(
+            tf.minimum(Kx[..., :, :-1], Kx[..., :, 1:]),
+            tf.minimum(Ky[..., :-1, :], Ky[..., 1:, :]),
+        )
+        order = tf.argsort(ke, stable=True)
+        ne = tf.searchsorted(tf.gather(ke, order), tf.range(L), side="right")
+
+        a = tf.gather(flat(Cx[..., :, :-1], Cy[..., :-1, :]), order)
+        b = tf.gather(flat(Cx[..., :, 1:], Cy[..., 1:, :]), order)
+        w = tf.gather(
+            flat(tf.broadcast_to(u, Cx[..., :, 1:].shape), tf.broadcast_to(v, Cy[..., 1:, :].shape)),
+            order,
+        )
+        # the flux is applied over the 2^k fine steps until the next update
+        f = tf.gather(
+            flat(tf.ones(Cx[..., :, 1:].shape) / dx, tf.ones(Cy[..., 1:, :].shape) / dy)
+            * 2.0 ** tf.cast(ke, h.dtype),
+            order,
+        )
+
+        kc = tf.reshape(k, [-1])
+        cells = tf.argsort(kc, stable=True)
+        nc = tf.searchsorted(tf.gather(kc, cells), tf.range(L), side="right")
+        m = tf.gather(
+            tf.reshape(tf.broadcast_to(smb, shape), [-1]) * 2.0 ** tf.cast(kc, h.dtype), cells
+        )
+
+        ddt = dt / N
+
+        def body(s, h, divflux):
+            # the class updated at the fine step s, i.e. the largest 2^l dividing s
+            l = tf.reduce_sum(tf.cast(s % (2 ** tf.range(1, L)) == 0, "int32"))
+
+            ab = tf.concat([a[: ne[l]], b[: ne[l]]], 0)[:, None]
+            q = w[: ne[l]] * tf.where(
+                w[: ne[l]] > 0, tf.gather(h, a[: ne[l]]), tf.gather(h, b[: ne[l]])
+            ) * f[: ne[l]]
+            div = tf.concat([q, -q], 0)
+
+            h = tf.tensor_scatter_nd_add(h, ab, -ddt * div)
+            divflux = tf.tensor_scatter_nd_add(divflux, ab, div / N)
+
+            c = cells[: nc[l]][:, None]
+            h = tf.tensor_scatter_nd_add(h, c, ddt * m[: nc[l]])
+
+            # projection on the cells updated, and on those receiving a flux
+            i = tf.concat([c, ab], 0)
+            h = tf.tensor_scatter_nd_update(h, i, tf.maximum(tf.gather_nd(h, i), 0))
+            h = tf.tensor_scatter_nd_update(h, [[n]], [0.0])
+
+            return s + 1, h, divflux
+
+        zeros = tf.zeros([n + 1], dtype=h.dtype)
+
+        _, h, divflux = tf.while_loop(
+            lambda s, h, divflux: s < N,
+            body,
+            [tf.constant(0), tf.concat([tf.reshape(h, [-1]), [0.0]], 0), zeros],
+        )
+
+        return tf.reshape(h[:n], shape), tf.reshape(divflux[:n], shape)
+
+    @tf.function()
+    def compute_thk_implicit(self, u, v, h, smb, dt, dx, dy):
+        """
+        #   backward Euler in time and upwind in space, u and v being frozen over the step
+        #   the outflow of each cell is treated on the diagonal, the inflow from the
+        #   neighbours is solved with projected Jacobi iterations; as the inflow is
+        #   non-negative the iterates remain non-negative whatever dt (no CFL limit)
+        #   return the new thickness and the thickness change of the last iteration
+        """
+
+        u = tf.concat(
+            [u[..., :, 0:1], 0.5 * (u[..., :, :-1] + u[..., :, 1:]), u[..., :, -1:]], -1
+        )  # has shape (ny,nx+1)
+        v = tf.concat(
+            [v[..., 0:1, :], 0.5 * (v[..., :-1, :] + v[..., 1:, :]), v[..., -1:, :]], -2
+        )  # has shape (ny+1,nx)
+
+        up, um = tf.maximum(u, 0), tf.minimum(u, 0)
+        vp, vm = tf.maximum(v, 0), tf.minimum(v, 0)
+
+        # outflow rate of each cell, has shape (ny,nx)
+        D = (up[..., :, 1:] - um[..., :, :-1]) / dx + (vp[..., 1:, :] - vm[..., :-1, :]) / dy
+
+        P = [[0, 0]] * (len(h.shape) - 2)
+
+        def inflow(h):
+            Hx = tf.pad(h, P + [[0, 0], [1, 1]], "CONSTANT")  # has shape (ny,nx+2)
+            Hy = tf.pad(h, P + [[1, 1], [0, 0]], "CONSTANT")  # has shape (ny+2,nx)
+            return (up[..., :, :-1] * Hx[..., :, :-2] - um[..., :, 1:] * Hx[..., :, 2:]) / dx + (
+                vp[..., :-1, :] * Hy[..., :-2, :] - vm[..., 1:, :] * Hy[..., 2:, :]
+            ) / dy
+
+        rhs = h + dt * smb
+        diag = 1 + dt * D
+
+        def body(k, hk, err):
+            hn = tf.maximum((rhs + dt * inflow(hk)) / diag, 0)
+            return k + 1, hn, tf.reduce_max(tf.abs(hn - hk))
+
+        _, h, err = tf.while_loop(
+            lambda k, hk, err: (k < self.config.transport_implicit_iter)
+            & (err > self.config.transport_implicit_tol),
+            body,
+            [tf.constant(0), h, tf.constant(np.inf, dtype=h.dtype)],
+        )
 
-        ## Computation of the divergence, final shape is (ny,nx)
-        return (Qx[:, 1:] - Qx[:, :-1]) / dx + (Qy[1:, :] - Qy[:-1, :]) / dy
+        return h, err
     
     ####################################################################################
     ####################################################################################
@@ -1242,11 +3638,11 @@ class igm:
         """
 
         if self.config.verbosity == 1:
-            print("Update TRACKING at time : ", igm.t)
+            print("Update TRACKING at time : ", self.scheduler.t)
             
         if not hasattr(self, "already_called_update_tracking"):
             self.already_called_update_tracking = True
-            self.tlast_seeding = -1.0e5000
+            self.scheduler.register("seeding", self.config.frequency_seeding)
             self.tcomp["Tracking"] = []
             
             # initialize trajectories
@@ -1269,7 +3665,7 @@ class igm:
             
         else:
                    
-            if (self.t.numpy() - self.tlast_seeding) >= self.config.frequency_seeding:
+            if self.scheduler.due("seeding"):
                 self.seeding_particles()
                 
                 # merge the new seeding points with the former ones
@@ -1278,8 +3674,7 @@ class igm:
                 self.rhpos = tf.Variable(tf.concat([self.rhpos,self.nrhpos],axis=-1))
                 self.wpos  = tf.Variable(tf.concat([self.wpos,self.nwpos],axis=-1))
                 
-                self.tlast_seeding = self.t.numpy()
-                self.seedtimes.append([self.t.numpy(),self.xpos.shape[0]])
+                self.seedtimes.append([self.scheduler.t,self.xpos.shape[0]])
                  
             self.tcomp["Tracking"].append(time.time())
             
@@ -1350,26 +3745,37 @@ class igm:
     def update_write_trajectories(self):
         
         if self.saveresult:
+
+            self.submit_output(
+                self.write_trajectories,
+                self.scheduler.t,
+                list(self.seedtimes),
+                self.xpos.numpy(),
+                self.ypos.numpy(),
+                self.rhpos.numpy(),
+            )
+
+    def write_trajectories(self, t, seedtimes, xpos, ypos, rhpos):
         
-            for i in range(len(self.seedtimes)):
-                
-                yearseed = self.seedtimes[i][0]
-                i0=0
-                if i>0:
-                    i0 = self.seedtimes[i-1][1]
-                i1     = self.seedtimes[i][1]
+        for i in range(len(seedtimes)):
             
-                filename="x-"+str(int(yearseed))+".dat"
-                with open(os.path.join(self.config.working_dir, 'trajectories', filename), 'a') as f:
-                    print( *list(np.concatenate([[self.t.numpy()],self.xpos[i0:i1].numpy()],axis=0)), file=f )
-                    
-                filename="y-"+str(int(yearseed))+".dat"
-                with open(os.path.join(self.config.working_dir, 'trajectories', filename), 'a') as f:
-                    print( *list(np.concatenate([[self.t.numpy()],self.ypos[i0:i1].numpy()],axis=0)), file=f )
-                    
-                filename="z-"+str(int(yearseed))+".dat"
-                with open(os.path.join(self.config.working_dir, 'trajectories', filename), 'a') as f:
-                    print( *list(np.concatenate([[self.t.numpy()],self.rhpos[i0:i1].numpy()],axis=0)), file=f )
+            yearseed = seedtimes[i][0]
+            i0=0
+            if i>0:
+                i0 = seedtimes[i-1][1]
+            i1     = seedtimes[i][1]
+        
+            filename="x-"+str(int(yearseed))+".dat"
+            with open(os.path.join(self.config.working_dir, 'trajectories', filename), 'a') as f:
+                print( *list(np.concatenate([[t],xpos[i0:i1]],axis=0)), file=f )
+                
+            filename="y-"+str(int(yearseed))+".dat"
+            with open(os.path.join(self.config.working_dir, 'trajectories', filename), 'a') as f:
+                print( *list(np.concatenate([[t],ypos[i0:i1]],axis=0)), file=f )
+                
+            filename="z-"+str(int(yearseed))+".dat"
+            with open(os.path.join(self.config.working_dir, 'trajectories', filename), 'a') as f:
+                print( *list(np.concatenate([[t],rhpos[i0:i1]],axis=0)), file=f )
    
     ####################################################################################
     ####################################################################################
@@ -1545,105 +3951,55 @@ class igm:
 
         if force | self.saveresult:
 
-            if self.it == 0:
+            if not hasattr(self, "already_initialized_ncdf_3d_ex"):
 
                 if self.config.verbosity == 1:
                     print("Initialize NCDF output Files")
 
-                nc = Dataset(
-                    os.path.join(self.config.working_dir, "ex3d.nc"),
-                    "w",
-                    format="NETCDF4",
-                )
-
-                nc.createDimension("time", None)
-                E = nc.createVariable("time", np.dtype("float32").char, ("time",))
-                E.units = "yr"
-                E.long_name = "time"
-                E.axis = "T"
-                E[0] = self.t.numpy()
-
-                nc.createDimension("h", self.height.shape[0])
-                E = nc.createVariable("h", np.dtype("float32").char, ("h",))
-                E.units = "m"
-                E.long_name = "h"
-                E.standard_name = "h"
-                E.axis = "H"
-                E[:] = self.height
-
-                nc.createDimension("y", len(self.y))
-                E = nc.createVariable("y", np.dtype("float32").char, ("y",))
-                E.units = "m"
-                E.long_name = "y"
-                E.axis = "Y"
-                E[:] = self.y.numpy()
-
-                nc.createDimension("x", len(self.x))
-                E = nc.createVariable("x", np.dtype("float32").char, ("x",))
-                E.units = "m"
-                E.long_name = "x"
-                E.axis = "X"
-                E[:] = self.x.numpy()
-
-                E = nc.createVariable(
-                    "topg", np.dtype("float32").char, ("time", "y", "x")
-                )
-                E.units = "m"
-                E.long_name = "topg"
-                E.standard_name = "topg"
-                E[0, :, :] = self.topg.numpy()
-
-                E = nc.createVariable(
-                    "usurf", np.dtype("float32").char, ("time", "y", "x")
-                )
-                E.units = "m"
-                E.long_name = "usurf"
-                E.standard_name = "usurf"
-                E[0, :, :] = self.usurf.numpy()
-
-                E = nc.createVariable(
-                    "U", np.dtype("float32").char, ("time", "h", "y", "x")
-                )
-                E.units = "m/y"
-                E.long_name = "U"
-                E.standard_name = "U"
-                E[0, :, :, :] = self.U.numpy()
-
-                E = nc.createVariable(
-                    "V", np.dtype("float32").char, ("time", "h", "y", "x")
-                )
-                E.units = "m/y"
-                E.long_name = "V"
-                E.standard_name = "V"
-                E[0, :, :, :] = self.V.numpy()
-
-                E = nc.createVariable(
-                    "W", np.dtype("float32").char, ("time", "h", "y", "x")
-                )
-                E.units = "m/y"
-                E.long_name = "W"
-                E.standard_name = "W"
-                E[0, :, :, :] = self.W.numpy()
-
-                nc.close()
-
-            else:
-
-                nc = Dataset(
-                    os.path.join(self.config.working_dir, "ex3d.nc"),
-                    "a",
-                    format="NETCDF4",
+                self.submit_output(
+                    self.init_ncdf_writer,
+                    "ex3d",
+                    "ex3d.nc",
+                    [
+                        ("h", self.height, "m", "H", "h"),
+                        ("y", self.y.numpy(), "m", "Y"),
+                        ("x", self.x.numpy(), "m", "X"),
+                    ],
+                    [
+                        (
+                            var,
+                            ("y", "x"),
+                            var,
+                            "m",
+                            var,
+                            self.ncdf_encoding(var, self.thk.shape),
+                        )
+                        for var in ["topg", "usurf"]
+                    ]
+                    + [
+                        (
+                            var,
+                            ("h", "y", "x"),
+                            var,
+                            "m/y",
+                            var,
+                            self.ncdf_encoding(var, self.U.shape),
+                        )
+                        for var in ["U", "V", "W"]
+                    ],
                 )
-
-                d = nc.variables["time"][:].shape[0]
-                nc.variables["time"][d] = self.t.numpy()
-                nc.variables["U"][d, :, :, :] = self.U.numpy()
-                nc.variables["V"][d, :, :, :] = self.V.numpy()
-                nc.variables["W"][d, :, :, :] = self.W.numpy()
-                nc.variables["usurf"][d, :, :] = self.usurf.numpy()
-                nc.variables["topg"][d, :, :] = self.topg.numpy()
-
-                nc.close()
+                self.already_initialized_ncdf_3d_ex = True
+
+            self.submit_output(
+                self.append_ncdf_writer,
+                "ex3d",
+                self.scheduler.t,
+                {
+                    var: vars(self)[var].numpy()
+                    for var in ["topg", "usurf", "U", "V", "W"]
+                },
+                self.scheduler.t >= self.config.tend,
+            )
 
     ####################################################################################
     ####################################################################################
@@ -1940,6 +4296,9 @@ class igm:
 
         ###### PERFORM CHECKS PRIOR OPTIMIZATIONS
 
+        # the gradients are computed through the emulator
+        assert self.iceflow_backend.differentiable
+
         # make sure this condition is satisfied
         assert ("usurf" in self.config.opti_cost) == (
             "usurf" in self.config.opti_control
@@ -2151,7 +4510,7 @@ class igm:
                     )
 
                 # evalutae th ice flow emulator
-                Y = self.iceflow_model(X)
+                Y = self.iceflow_backend.predict(X)
 
                 # get the dimensions of the working array
                 Ny, Nx = self.thk.shape
@@ -2538,6 +4897,22 @@ class igm:
             fmt="%.3f",
         )
 
+        # the sub-cycling of the forward run starts from the optimized thickness
+        self.it_last_iceflow = self.it
+        self.thk_last_iceflow.assign(self.thk)
+
+    def run_quantize(self):
+
+        self.initialize()
+
+        with tf.device(self.device_name):
+
+            self.load_ncdf_data(self.config.geology_file)
+
+            self.initialize_fields()
+
+            self.quantize_iceflow_model()
+
     def run_opti(self):
 
         self.initialize()
@@ -2657,60 +5032,62 @@ class igm:
 
         if it == 0:
 
-            nc = Dataset(
-                os.path.join(self.config.working_dir, "optimize.nc"),
-                "w",
-                format="NETCDF4",
-            )
+            with ncdf_lock:
+                nc = Dataset(
+                    os.path.join(self.config.working_dir, "optimize.nc"),
+                    "w",
+                    format="NETCDF4",
+                )
 
-            nc.createDimension("iterations", None)
-            E = nc.createVariable("iterations", dtype("float32").char, ("iterations",))
-            E.units = "None"
-            E.long_name = "iterations"
-            E.axis = "ITERATIONS"
-            E[0] = it
+                nc.createDimension("iterations", None)
+                E = nc.createVariable("iterations", dtype("float32").char, ("iterations",))
+                E.units = "None"
+                E.long_name = "iterations"
+                E.axis = "ITERATIONS"
+                E[0] = it
 
-            nc.createDimension("y", len(self.y))
-            E = nc.createVariable("y", dtype("float32").char, ("y",))
-            E.units = "m"
-            E.long_name = "y"
-            E.axis = "Y"
-            E[:] = self.y.numpy()
+                nc.createDimension("y", len(self.y))
+                E = nc.createVariable("y", dtype("float32").char, ("y",))
+                E.units = "m"
+                E.long_name = "y"
+                E.axis = "Y"
+                E[:] = self.y.numpy()
 
-            nc.createDimension("x", len(self.x))
-            E = nc.createVariable("x", dtype("float32").char, ("x",))
-            E.units = "m"
-            E.long_name = "x"
-            E.axis = "X"
-            E[:] = self.x.numpy()
+                nc.createDimension("x", len(self.x))
+                E = nc.createVariable("x", dtype("float32").char, ("x",))
+                E.units = "m"
+                E.long_name = "x"
+                E.axis = "X"
+                E[:] = self.x.numpy()
 
-            for var in self.config.opti_vars_to_save:
+                for var in self.config.opti_vars_to_save:
 
-                E = nc.createVariable(
-                    var, dtype("float32").char, ("iterations", "y", "x")
-                )
-                # E.long_name = self.var_info[var][0]
-                # E.units = self.var_info[var][1]
-                E[0, :, :] = vars(self)[var].numpy()
+                    E = nc.createVariable(
+                        var, dtype("float32").char, ("iterations", "y", "x")
+                    )
+                    # E.long_name = self.var_info[var][0]
+                    # E.units = self.var_info[var][1]
+                    E[0, :, :] = vars(self)[var].numpy()
 
-            nc.close()
+                nc.close()
 
         else:
 
-            nc = Dataset(
-                os.path.join(self.config.working_dir, "optimize.nc"),
-                "a",
-                format="NETCDF4",
-            )
+            with ncdf_lock:
+                nc = Dataset(
+                    os.path.join(self.config.working_dir, "optimize.nc"),
+                    "a",
+                    format="NETCDF4",
+                )
 
-            d = nc.variables["iterations"][:].shape[0]
+                d = nc.variables["iterations"][:].shape[0]
 
-            nc.variables["iterations"][d] = it
+                nc.variables["iterations"][d] = it
 
-            for var in self.config.opti_vars_to_save:
-                nc.variables[var][d, :, :] = vars(self)[var].numpy()
+                for var in self.config.opti_vars_to_save:
+                    nc.variables[var][d, :, :] = vars(self)[var].numpy()
 
-            nc.close()
+                nc.close()
 
     def output_ncdf_optimize_final(self):
         """
@@ -2720,11 +5097,12 @@ class igm:
         if self.config.verbosity == 1:
             print("Write the final geology ncdf file after optimization")
 
-        nc = Dataset(
-            os.path.join(self.config.working_dir, self.config.observation_file), "r"
-        )
-        varori = [v for v in nc.variables]
-        nc.close()
+        with ncdf_lock:
+            nc = Dataset(
+                os.path.join(self.config.working_dir, self.config.observation_file), "r"
+            )
+            varori = [v for v in nc.variables]
+            nc.close()
 
         varori.remove("x")
         varori.remove("y")
@@ -2757,35 +5135,36 @@ class igm:
             self.thk > 1.0, tf.ones_like(self.thk), tf.zeros_like(self.thk)
         )
 
-        nc = Dataset(
-            os.path.join(self.config.working_dir, self.config.geology_optimized_file),
-            "w",
-            format="NETCDF4",
-        )
+        with ncdf_lock:
+            nc = Dataset(
+                os.path.join(self.config.working_dir, self.config.geology_optimized_file),
+                "w",
+                format="NETCDF4",
+            )
 
-        nc.createDimension("y", len(self.y))
-        E = nc.createVariable("y", dtype("float32").char, ("y",))
-        E.units = "m"
-        E.long_name = "y"
-        E.axis = "Y"
-        E[:] = self.y.numpy()
+            nc.createDimension("y", len(self.y))
+            E = nc.createVariable("y", dtype("float32").char, ("y",))
+            E.units = "m"
+            E.long_name = "y"
+            E.axis = "Y"
+            E[:] = self.y.numpy()
 
-        nc.createDimension("x", len(self.x))
-        E = nc.createVariable("x", dtype("float32").char, ("x",))
-        E.units = "m"
-        E.long_name = "x"
-        E.axis = "X"
-        E[:] = self.x.numpy()
+            nc.createDimension("x", len(self.x))
+            E = nc.createVariable("x", dtype("float32").char, ("x",))
+            E.units = "m"
+            E.long_name = "x"
+            E.axis = "X"
+            E[:] = self.x.numpy()
 
-        for var in varori:
+            for var in varori:
 
-            if hasattr(self, var):
-                E = nc.createVariable(var, dtype("float32").char, ("y", "x"))
-                #                E.long_name = self.var_info[var][0]
-                #                E.units     = self.var_info[var][1]
-                E[:, :] = vars(self)[var].numpy()
+                if hasattr(self, var):
+                    E = nc.createVariable(var, dtype("float32").char, ("y", "x"))
+                    #                E.long_name = self.var_info[var][0]
+                    #                E.units     = self.var_info[var][1]
+                    E[:, :] = vars(self)[var].numpy()
 
-        nc.close()
+            nc.close()
 
     def plot_cost_functions(self, costs, plot_live):
 
@@ -3100,6 +5479,146 @@ class igm:
             )
             plt.close("all")
 
+    ####################################################################################
+    ####################################################################################
+    ####################################################################################
+    #                              FUSED STEP
+    ####################################################################################
+    ####################################################################################
+    ####################################################################################
+
+    def read_config_param_fused_step(self):
+
+        self.parser.add_argument(
+            "--fused_step",
+            type=str2bool,
+            default=False,
+            help="Compute ice flow, time step and transport within a single TensorFlow graph; particles are then tracked after the transport, with the time step just done and the updated thickness, instead of before the time step (False)",
+        )
+
+    def update_fused_step(self):
+        """
+        replace update_iceflow, update_t_dt and update_thk by a single compiled
+        graph, which is given the time left to the next save and returns the time
+        step, such that each step needs a single device-to-host transfer, the time
+        being still advanced on the host in float64
+        """
+
+        if not hasattr(self, "already_called_update_fused_step"):
+
+            # the first call initializes all components as in the non-fused mode
+            self.update_iceflow()
+            self.update_t_dt()
+            self.update_thk()
+
+            # the fused step is timed as a whole
+            for key in ["Ice flow", "Time step", "Transport"]:
+                del self.tcomp[key]
+            self.tcomp["Fused step"] = []
+
+            # these fields are re-assigned (and not re-defined) within the graph
+            self.divflux = tf.Variable(self.divflux)
+            self.slopsurfx = tf.Variable(self.slopsurfx)
+            self.slopsurfy = tf.Variable(self.slopsurfy)
+
+            self.already_called_update_fused_step = True
+
+        else:
+
+            self.tcomp["Fused step"].append(time.time())
+
+            update_iceflow = (
+                self.it - self.it_last_iceflow
+            ) >= self.config.iceflow_update_freq
+
+            # the reduced precision emulator is checked on the host
+            if update_iceflow & (not self.iceflow_precision_checked):
+                X = self.iceflow_input()
+                self.check_iceflow_precision(X, self.iceflow_predict(X))
+
+            dt, dt_target, save, updated = self.fused_step_tf(
+                tf.constant(update_iceflow),
+                tf.constant(self.tsave[self.itsave + 1] - self.scheduler.t, dtype="float32"),
+                self.iceflow_precision,
+            ).numpy()
+
+            if updated > 0.5:
+                self.it_last_iceflow = self.it
+
+            self.dt = float(dt)
+            self.dt_target = float(dt_target)
+
+            if self.config.transport_scheme == "multirate":
+                self.update_dt_class_count()
+
+            self.saveresult = bool(save > 0.5)
+
+            # the saving times are hit exactly, as in update_t_dt
+            if self.saveresult:
+                self.itsave += 1
+                self.scheduler.t = self.tsave[self.itsave]
+            else:
+                self.scheduler.t += self.dt
+
+            self.t.assign(self.scheduler.t)
+
+            self.it += 1
+
+            if self.config.verbosity == 1:
+                print("Fused step at time : ", self.scheduler.t)
+
+            self.tcomp["Fused step"][-1] -= time.time()
+            self.tcomp["Fused step"][-1] *= -1
+
+    @tf.function()
+    def fused_step_tf(self, update_iceflow, tleft, precision):
+        """
+        emulated ice flow, CFL time step, and upwind transport in one graph, tleft
+        is the time left to the next save, precision is the one of the emulator,
+        the graph is re-traced if it changes
+        """
+
+        if self.config.iceflow_update_thr > 0:
+            update_iceflow = tf.logical_or(
+                update_iceflow,
+                self.iceflow_thk_change() > self.config.iceflow_update_thr,
+            )
+
+        def emulate():
+            self.iceflow_output(self.iceflow_predict(self.iceflow_input()))
+            self.thk_last_iceflow.assign(self.thk)
+            return tf.constant(1.0)
+
+        updated = tf.cond(update_iceflow, emulate, lambda: tf.constant(0.0))
+
+        velomax = tf.maximum(
+            tf.math.reduce_max(tf.math.abs(self.ubar)),
+            tf.math.reduce_max(tf.math.abs(self.vbar)),
+        )
+
+        # velomax = 0 gives an infinite CFL time step, and therefore dtmax
+        dt_target = tf.minimum(
+            self.config.cfl * self.dx / velomax * self.dt_multirate_factor(),
+            self.config.dtmax,
+        )
+
+        save = tleft <= dt_target
+        dt = tf.where(save, tleft, dt_target)
+
+        thk, divflux = self.transport_step(dt)
+
+        self.divflux.assign(divflux)
+
+        self.thk.assign(thk)
+
+        self.usurf.assign(self.topg + self.thk)
+
+        slopsurfx, slopsurfy = self.compute_gradient_tf(self.usurf, self.dx, self.dx)
+        self.slopsurfx.assign(slopsurfx)
+        self.slopsurfy.assign(slopsurfy)
+
+        return tf.stack([dt, dt_target, tf.cast(save, "float32"), updated])
+
     ####################################################################################
     ####################################################################################
     ####################################################################################
@@ -3140,8 +5659,11 @@ class igm:
 
             if self.config.varplot == "velbar_mag":
                 self.velbar_mag = self.getmag(self.ubar, self.vbar)
-                
 
+            # only the first member is plotted in case of ensemble
+            field = vars(self)[self.config.varplot]
+            if len(field.shape) == 3:
+                field = field[0]
 
             if firstime:
 
@@ -3149,7 +5671,7 @@ class igm:
                 self.ax = self.fig.add_subplot(1, 1, 1)
                 self.ax.axis("off")
                 im = self.ax.imshow(
-                    vars(self)[self.config.varplot],
+                    field,
                     origin="lower",
                     cmap="viridis",
                     vmin=0,
@@ -3161,12 +5683,12 @@ class igm:
                                               y=(self.ypos[::r]-self.y[0])/self.dx, \
                                               c=1-self.rhpos[::r].numpy(), vmin=0, vmax=1, \
                                               s=0.5, cmap="RdBu")
-                self.ax.set_title("YEAR : " + str(self.t.numpy()), size=15)
+                self.ax.set_title("YEAR : " + str(self.scheduler.t), size=15)
                 self.cbar = plt.colorbar(im)
 
             else:
                 im = self.ax.imshow(
-                    vars(self)[self.config.varplot],
+                    field,
                     origin="lower",
                     cmap="viridis",
                     vmin=0,
@@ -3179,7 +5701,7 @@ class igm:
                                               y=(self.ypos[::r]-self.y[0])/self.dx, \
                                               c=1-self.rhpos[::r].numpy(), vmin=0, vmax=1, \
                                               s=0.5, cmap="RdBu")
-                self.ax.set_title("YEAR : " + str(self.t.numpy()), size=15)
+                self.ax.set_title("YEAR : " + str(self.scheduler.t), size=15)
 
             if self.config.plot_live:
                 clear_output(wait=True)
@@ -3191,7 +5713,7 @@ class igm:
                         self.config.working_dir,
                         self.config.varplot
                         + "-"
-                        + str(self.t.numpy()).zfill(4)
+                        + str(self.scheduler.t).zfill(4)
                         + ".png",
                     ),
                     bbox_inches="tight",
@@ -3311,12 +5833,39 @@ class igm:
                 % (
                     datetime.datetime.now().strftime("%H:%M:%S"),
                     self.it,
-                    self.t,
+                    self.scheduler.t,
                     self.dt_target,
-                    np.sum(self.thk) * (self.dx ** 2) / 10 ** 9,
+                    tf.reduce_mean(tf.reduce_sum(self.thk, axis=(-2, -1))).numpy()
+                    * (self.dx ** 2)
+                    / 10 ** 9,
                 )
             )
 
+            if self.config.transport_scheme == "multirate":
+                count = self.dt_class_count.numpy()
+                frac = 100 * count / max(np.sum(count), 1)
+                print(
+                    "    Ice cells per local time step (in fine steps) : "
+                    + "  |  ".join(
+                        "%d : %5.1f %%" % (2 ** k, f) for k, f in enumerate(frac)
+                    )
+                )
+                self.dt_class_count.assign(tf.zeros_like(self.dt_class_count))
+
+            if self.config.transport_scheme == "implicit":
+                unconverged = self.implicit_unconverged.numpy()
+                if unconverged > 0:
+                    print(
+                        "    WARNING : the implicit transport did not converge within %d iterations at %d steps (thickness change up to %.3g m at the last one), increase transport_implicit_iter or decrease cfl"
+                        % (
+                            self.config.transport_implicit_iter,
+                            unconverged,
+                            self.implicit_residual.numpy(),
+                        )
+                    )
+                self.implicit_unconverged.assign(0)
+                self.implicit_residual.assign(0.0)
+
     def print_comp_info_live(self):
         """
         This serves to print computational info on the fly during computation
@@ -3359,6 +5908,12 @@ class igm:
                     "     %15s  |  mean time per it : %8.4f  |  total : %8.4f  |  number it  : %8.0f"
                     % CELA
                 )
+            for key in self.tinit.keys():
+                print(
+                    "     %15s  |  one-time cost : %8.4f" % (key, self.tinit[key]),
+                    file=f,
+                )
+                print("     %15s  |  one-time cost : %8.4f" % (key, self.tinit[key]))
 
     ####################################################################################
     ####################################################################################
@@ -3399,7 +5954,7 @@ class igm:
             #     self.init_3dvel()
             # self.print_info()
 
-            while self.t.numpy() < self.config.tend:
+            while self.scheduler.t < self.config.tend:
 
                 self.tcomp["All"].append(time.time())
 
@@ -3410,15 +5965,26 @@ class igm:
 
                 self.update_smb()
 
-                self.update_iceflow()
-                
-                if self.config.tracking_particles:
-                    self.update_tracking_particles()
-                    self.update_write_trajectories()
+                if self.config.fused_step:
+
+                    self.update_fused_step()
 
-                self.update_t_dt()
+                    # unlike below, the particles see the thickness and time step after transport
+                    if self.config.tracking_particles:
+                        self.update_tracking_particles()
+                        self.update_write_trajectories()
 
-                self.update_thk()
+                else:
+
+                    self.update_iceflow()
+
+                    if self.config.tracking_particles:
+                        self.update_tracking_particles()
+                        self.update_write_trajectories()
+
+                    self.update_t_dt()
+
+                    self.update_thk()
 
                 if self.config.update_topg:
                     self.update_topg()
@@ -3434,9 +6000,169 @@ class igm:
                 self.tcomp["All"][-1] -= time.time()
                 self.tcomp["All"][-1] *= -1
 
+        self.close_ncdf()
+
         self.print_all_comp_info()
 
 
+####################################################################################
+
+def sweep_worker_init(num_threads, preload_models):
+    """
+    Pin the threads of a worker process, and load the models it will need
+    """
+
+    global backend_threads
+
+    set_num_threads(num_threads, 1)
+    backend_threads = num_threads
+
+    for filepath in preload_models:
+        load_keras_model(filepath)
+
+def sweep_worker_run(task):
+    """
+    Run one simulation of the parameter sweep within a worker process, the
+    output of the run is logged in working_dir/igm-run.log
+    """
+
+    igm_class, working_dir, params = task
+
+    os.makedirs(working_dir, exist_ok=True)
+
+    start = time.time()
+    error = None
+
+    try:
+        with open(os.path.join(working_dir, "igm-run.log"), "w") as f:
+            with contextlib.redirect_stdout(f):
+                model = igm_class()
+                for key, value in params.items():
+                    setattr(model.config, key, value)
+                model.config.working_dir = working_dir
+                model.run()
+    except Exception:
+        error = traceback.format_exc()
+
+    return working_dir, time.time() - start, error
+
+def write_sweep_summary(filename, tasks, results):
+    """
+    Gather the ts.nc files of the runs of a sweep into one table, with one
+    line per run, member and saving time
+    """
+
+    keys = sorted(set(key for _, _, params in tasks for key in params))
+
+    with open(filename, "w") as f:
+
+        print(
+            "\t".join(
+                ["run", "working_dir", "status", "comptime"]
+                + keys
+                + ["member", "time", "vol", "area"]
+            ),
+            file=f,
+        )
+
+        for i, ((_, working_dir, params), (_, comptime, error)) in enumerate(
+            zip(tasks, results)
+        ):
+
+            line = [
+                str(i),
+                working_dir,
+                "ok" if error is None else "failed",
+                "%.1f" % comptime,
+            ] + [str(params.get(key, "")) for key in keys]
+
+            filepath = os.path.join(working_dir, "ts.nc")
+
+            if (error is not None) | (not os.path.exists(filepath)):
+                print("\t".join(line), file=f)
+                continue
+
+            with ncdf_lock:
+                nc = Dataset(filepath, "r")
+                t = np.array(nc.variables["time"][:])
+                vol = np.reshape(nc.variables["vol"][:], (len(t), -1))
+                area = np.reshape(nc.variables["area"][:], (len(t), -1))
+                nc.close()
+
+            for m in range(vol.shape[1]):
+                for k in range(len(t)):
+                    print(
+                        "\t".join(
+                            line
+                            + [str(m), "%g" % t[k], "%g" % vol[k, m], "%g" % area[k, m]]
+                        ),
+                        file=f,
+                    )
+
+def run_parameter_sweep(
+    runs,
+    nprocs=None,
+    num_threads=None,
+    preload_models=None,
+    summary_file="sweep-summary.txt",
+    igm_class=None,
+):
+    """
+    Run independent IGM simulations in parallel over a pool of nprocs worker
+    processes (default: number of cores / num_threads), each worker being
+    pinned to num_threads threads (default: number of cores / nprocs, 1 if
+    nprocs is not given either).
+
+    runs is a list of dict of config parameters, e.g.
+    [{'geology_file': '/data/ticino-1000.nc', 'tend': -15000}, ...], each run
+    writes into its own working_dir (default: run-000, run-001, ...), input
+    files must therefore be given with absolute paths. The models listed in
+    preload_models (path to model.h5) are loaded once per worker before the
+    first run, and are otherwise loaded at the first run using them and
+    re-used by the next ones.
+
+    The ts.nc of all runs are gathered into summary_file. igm_class (default
+    igm) can be a derived class, it must then be importable by the workers,
+    i.e. defined in a module, or in a script whose main part is protected by
+    if __name__ == "__main__":
+    """
+
+    if igm_class is None:
+        igm_class = igm
+
+    if preload_models is None:
+        preload_models = []
+
+    if num_threads is None:
+        num_threads = 1 if nprocs is None else max(os.cpu_count() // nprocs, 1)
+
+    if nprocs is None:
+        nprocs = max(os.cpu_count() // num_threads, 1)
+
+    tasks = []
+    for i, params in enumerate(runs):
+        params = dict(params)
+        working_dir = os.path.abspath(params.pop("working_dir", "run-%03d" % i))
+        tasks.append((igm_class, working_dir, params))
+
+    results = []
+
+    with multiprocessing.get_context("spawn").Pool(
+        nprocs, initializer=sweep_worker_init, initargs=(num_threads, preload_models)
+    ) as pool:
+        for result in pool.imap(sweep_worker_run, tasks, chunksize=1):
+            print(
+                "Run in %s %s after %.1f s"
+                % (result[0], "done" if result[2] is None else "failed", result[1])
+            )
+            if result[2] is not None:
+                print(result[2])
+            results.append(result)
+
+    write_sweep_summary(summary_file, tasks, results)
+
+    return results
+
 ####################################################################################
 ####################################################################################
 ####################################################################################